@@ -0,0 +1,86 @@
+#!/usr/bin/python2.5
+
+# Measures coffeeshop's cold start: the time to import the application
+# and the time to its first response, each in a fresh process, along with
+# which of the lazily imported dependencies the import pulled in anyway
+#
+# Usage: startupbench.py [runs] [path]
+
+import os
+import sys
+import time
+import subprocess
+
+base_path = "/home/dj/dev/google_appengine"
+app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Modules that coffeeshop only imports when a request needs them
+LAZY = [
+  'google.appengine.ext.webapp.template',
+  'django.utils.simplejson',
+  'google.appengine.api.labs.taskqueue',
+  'google.appengine.api.urlfetch',
+]
+
+def child(path):
+  """Runs in the fresh process: imports coffeeshop, makes a single GET
+  request of path to it, and prints the timings for the parent
+  """
+  for p in [base_path, base_path + "/lib/webob", base_path + "/lib/django",
+            base_path + "/lib/yaml/lib", app_path]:
+    sys.path.append(p)
+
+  started = time.time()
+  import coffeeshop
+  imported = time.time()
+  loaded = [name for name in LAZY if name in sys.modules]
+
+  environ = {
+    'REQUEST_METHOD': 'GET',
+    'PATH_INFO': path,
+    'QUERY_STRING': '',
+    'SERVER_NAME': 'localhost',
+    'SERVER_PORT': '80',
+    'SERVER_PROTOCOL': 'HTTP/1.0',
+    'wsgi.url_scheme': 'http',
+    'wsgi.input': sys.stdin,
+    'wsgi.errors': sys.stderr,
+  }
+  status = []
+  def start_response(s, headers, exc_info=None):
+    status.append(s)
+  ''.join(coffeeshop.application(environ, start_response))
+  responded = time.time()
+
+  print "%f %f %s %s" % (imported - started, responded - started,
+    status[0].split()[0], ','.join(loaded))
+
+def main(runs, path):
+  imports, firsts = [], []
+  for run in range(runs):
+    output = subprocess.Popen(
+      [sys.executable, os.path.abspath(__file__), '--child', path],
+      stdout=subprocess.PIPE).communicate()[0].split()
+    imports.append(float(output[0]))
+    firsts.append(float(output[1]))
+    loaded = output[3:] and output[3].split(',') or []
+    print "run %d: import %.1fms, first response (%s) %.1fms" % (
+      run + 1, float(output[0]) * 1000, output[2], float(output[1]) * 1000)
+  imports.sort()
+  firsts.sort()
+  print "median: import %.1fms, first response %.1fms" % (
+    imports[runs / 2] * 1000, firsts[runs / 2] * 1000)
+  if loaded:
+    print "loaded eagerly: %s" % (', '.join(loaded), )
+
+if __name__ == "__main__":
+  if len(sys.argv) > 1 and sys.argv[1] == '--child':
+    child(sys.argv[2])
+  else:
+    runs = 5
+    path = '/'
+    if len(sys.argv) > 1:
+      runs = int(sys.argv[1])
+    if len(sys.argv) > 2:
+      path = sys.argv[2]
+    main(runs, path)
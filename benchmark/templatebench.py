@@ -0,0 +1,64 @@
+#!/usr/bin/python2.5
+
+# Measures the per-request saving from rendering pages with
+# coffeeshop.rendertemplate rather than webapp's template.render(path,
+# values), as the handlers used to. Both reuse compiled templates for the
+# life of the process, so this is the saving on each render once they've
+# been compiled (template.render still resolves the path and looks the
+# template up on every call). The first render of each page is left out.
+#
+# Usage: templatebench.py [renders]
+
+import datetime
+import os
+import sys
+import time
+
+base_path = "/home/dj/dev/google_appengine"
+sys.path.append(base_path)
+sys.path.append(base_path + "/lib/webob")
+sys.path.append(base_path + "/lib/django")
+sys.path.append(base_path + "/lib/yaml/lib")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from google.appengine.ext.webapp import template
+import coffeeshop
+
+RENDERS = 1000
+if len(sys.argv) > 1:
+  RENDERS = int(sys.argv[1])
+
+now = datetime.datetime.now()
+PAGES = [
+  ('index.html', {
+    'version': coffeeshop.VERSION,
+    'server_software': 'benchmark',
+  }),
+  ('channel_list.html', {
+    'channels': [{
+      'channelid': n,
+      'name': 'channel-%d' % n,
+      'created': now,
+      'created_ago': 'just now',
+    } for n in range(1, coffeeshop.PAGE_SIZE + 1)],
+    'paging': { 'next': '/channel/?cursor=x', 'prev': None, 'first': None },
+  }),
+]
+
+def timeit(render):
+  started = time.time()
+  for i in range(RENDERS):
+    render()
+  return (time.time() - started) / RENDERS * 1000
+
+started = time.time()
+coffeeshop.warmtemplates()
+print "Warm-up: %.1fms" % ((time.time() - started) * 1000, )
+
+for name, values in PAGES:
+  path = os.path.join(coffeeshop.TEMPLATE_DIR, name)
+  template.render(path, values)
+  webapp = timeit(lambda: template.render(path, values))
+  compiled = timeit(lambda: coffeeshop.rendertemplate(name, values))
+  print "%-20s template.render %.3fms  rendertemplate %.3fms  saving %.3fms per render" % (
+    name, webapp, compiled, webapp - compiled)
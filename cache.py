@@ -0,0 +1,93 @@
+# In-process caching for coffeeshop
+import threading
+import time
+
+# Positions of the fields in a cache entry's link
+PREV, NEXT, KEY, VALUE, EXPIRES = 0, 1, 2, 3, 4
+
+class LRUCache(object):
+  """A thread-safe, in-process cache holding at most size entries,
+  each of which expires ttl seconds after it was set. When the cache
+  is full, the least recently used entry is evicted to make room.
+  """
+  def __init__(self, size, ttl):
+    self.size = size
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+    self._links = {}
+    # Entries are kept in a circular doubly linked list, with the
+    # most recently used next to the root and the least recently
+    # used just before it
+    self._root = []
+    self._root[:] = [self._root, self._root, None, None, None]
+
+  def _unlink(self, link):
+    link[PREV][NEXT] = link[NEXT]
+    link[NEXT][PREV] = link[PREV]
+
+  def _pushfront(self, link):
+    root = self._root
+    link[PREV] = root
+    link[NEXT] = root[NEXT]
+    root[NEXT][PREV] = link
+    root[NEXT] = link
+
+  def get(self, key, default=None):
+    self._lock.acquire()
+    try:
+      link = self._links.get(key)
+      if link is None:
+        self.misses += 1
+        return default
+      if link[EXPIRES] <= time.time():
+        self._unlink(link)
+        del self._links[key]
+        self.misses += 1
+        return default
+      self._unlink(link)
+      self._pushfront(link)
+      self.hits += 1
+      return link[VALUE]
+    finally:
+      self._lock.release()
+
+  def set(self, key, value):
+    self._lock.acquire()
+    try:
+      link = self._links.get(key)
+      if link is not None:
+        self._unlink(link)
+      else:
+        link = [None, None, key, None, None]
+        self._links[key] = link
+      link[VALUE] = value
+      link[EXPIRES] = time.time() + self.ttl
+      self._pushfront(link)
+      while len(self._links) > self.size:
+        oldest = self._root[PREV]
+        self._unlink(oldest)
+        del self._links[oldest[KEY]]
+    finally:
+      self._lock.release()
+
+  def delete(self, key):
+    self._lock.acquire()
+    try:
+      link = self._links.pop(key, None)
+      if link is not None:
+        self._unlink(link)
+    finally:
+      self._lock.release()
+
+  def clear(self):
+    self._lock.acquire()
+    try:
+      self._links.clear()
+      self._root[:] = [self._root, self._root, None, None, None]
+    finally:
+      self._lock.release()
+
+  def __len__(self):
+    return len(self._links)
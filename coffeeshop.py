@@ -9,17 +9,27 @@ import cgi
 import logging
 import wsgiref.handlers
 import datetime
+import random
+import time
+import urllib
+import urlparse
+import base64
+import threading
 #import urllib2
 
-from models import Channel, Subscriber, Message, Delivery
+from models import Channel, ChannelSequence, Subscriber, Message, Delivery, DeliveryCounter, DeliveryShard
 from bucket import agoify
+from cache import LRUCache
+from throttle import HostThrottle
+from storage import db
 
-from google.appengine.ext.webapp import template
 from google.appengine.ext import webapp
-from google.appengine.ext import db
-from google.appengine.api.labs import taskqueue
-from google.appengine.api import urlfetch
-from django.utils import simplejson
+from google.appengine.api import memcache
+
+# The Django template machinery, simplejson, taskqueue and urlfetch are
+# each only needed by some requests, so they are imported where they are
+# used rather than here, keeping them out of the cost of a cold start.
+# See benchmark/startupbench.py
 
 VERSION = "0.01"
 DEBUG = True
@@ -27,14 +37,190 @@ DEBUG = True
 # Name of task queue for message distribution
 QUEUE_DISTRIBUTION='msgdist'
 
+# A worker that works through a queue of deliveries holds a lease on it
+# for up to WORKER_LEASE seconds, so no two of them send the same
+# deliveries at once. A worker that finds the lease taken comes back
+# WORKER_LEASE_RETRY seconds later
+WORKER_LEASE=60
+WORKER_LEASE_RETRY=5
+
+# Number of Delivery entities written per datastore round trip
+# when fanning a published message out to a channel's subscribers
+DELIVERY_BATCH_SIZE=200
+
+# Maximum number of deliveries handled by any one distribution task.
+# A message with more subscribers than this is distributed by several
+# tasks, each covering its own shard of the deliveries
+DISTRIBUTION_SHARD_SIZE=500
+
+# Maximum number of deliveries in flight at once for a message, and
+# the number of seconds to wait for any one subscriber to respond
+DELIVERY_CONCURRENCY=10
+DELIVERY_TIMEOUT=10
+
+# Outside App Engine, deliveries go over keep-alive connections pooled
+# per subscriber host (see transport.py), with at most
+# TRANSPORT_MAX_PER_HOST connections to a host, each closed once it has
+# been idle for TRANSPORT_IDLE_TIMEOUT seconds
+TRANSPORT_MAX_PER_HOST=10
+TRANSPORT_IDLE_TIMEOUT=30
+
+# Deliveries to each subscriber host go through a circuit breaker and an
+# adaptive rate limit (see throttle.py). After THROTTLE_FAILURES failures
+# in a row a host's breaker opens for THROTTLE_OPEN_TIME seconds, doubling
+# up to THROTTLE_OPEN_MAX each time a trial delivery fails. A host is sent
+# up to THROTTLE_MAX_RATE deliveries a second, a rate that is halved (down
+# to THROTTLE_MIN_RATE) on a 429 or 503, paused for any Retry-After, and
+# recovers with each success. The state of up to THROTTLE_HOSTS hosts is
+# kept in-process, for at most THROTTLE_TTL seconds
+THROTTLE_FAILURES=5
+THROTTLE_OPEN_TIME=30
+THROTTLE_OPEN_MAX=3600
+THROTTLE_MAX_RATE=50
+THROTTLE_MIN_RATE=0.2
+THROTTLE_HOSTS=1000
+THROTTLE_TTL=3600
+
+# A failed delivery is retried after an exponentially increasing
+# delay, starting at DELIVERY_BACKOFF_BASE seconds and doubling with
+# each attempt up to DELIVERY_BACKOFF_MAX seconds, with random jitter
+# so retries to the same subscriber don't bunch up
+DELIVERY_BACKOFF_BASE=10
+DELIVERY_BACKOFF_MAX=3600
+
+# A delivery that has failed DELIVERY_MAX_ATTEMPTS times, or is still
+# failing DELIVERY_MAX_AGE after it was created, is given up on and
+# dead-lettered. Dead-lettered deliveries can be re-driven in bulk,
+# up to DEADLETTER_BATCH_SIZE per request
+DELIVERY_MAX_ATTEMPTS=10
+DELIVERY_MAX_AGE=datetime.timedelta(days=2)
+DEADLETTER_BATCH_SIZE=500
+
+# Publishing normally fans a message out to its deliveries before
+# answering the publisher. A publisher that sends a "Prefer: respond-async"
+# header (or every publisher, if PUBLISH_ASYNC is set) instead gets a 202
+# straight away, and the fan-out is done by a task
+PUBLISH_ASYNC=False
+
+# Maximum number of messages in one batch publish, i.e. a POST to
+# /channel/{id}/?batch=1 of a JSON array or of newline-delimited messages
+PUBLISH_BATCH_MAX=500
+
+# A subscriber with a batch size takes its messages in batches, POSTed
+# as a JSON array of up to that many (and at most SUBSCRIBER_BATCH_MAX)
+# messages, once its batch wait of seconds has passed since the first
+# of them was ready, or sooner if the batch fills up
+SUBSCRIBER_BATCH_MAX=100
+
+# A pull subscriber isn't sent its messages, but fetches them from
+# /channel/{id}/subscriber/{id}/messages, up to PULL_BATCH_MAX at a time
+# (PAGE_SIZE by default), and acknowledges them there once processed
+MODE_PUSH='push'
+MODE_PULL='pull'
+PULL_BATCH_MAX=1000
+
+# A channel's messages can be streamed from /channel/{id}/stream, as
+# Server-Sent Events or by long-polling, with their sequence numbers as
+# event ids. A stream request waits up to STREAM_TIMEOUT seconds for new
+# messages, and returns up to STREAM_BATCH_MAX of them as soon as there
+# are any. A message published in the same process wakes it straight
+# away; one published elsewhere is noticed within STREAM_POLL_INTERVAL
+# seconds. An event stream client is asked to reconnect after
+# STREAM_RETRY milliseconds
+STREAM_TIMEOUT=20
+STREAM_POLL_INTERVAL=0.5
+STREAM_BATCH_MAX=100
+STREAM_RETRY=500
+
+# Each message published to a channel is given the next of the channel's
+# sequence numbers, so that its messages can be listed, and caught up on
+# from any of them, by a range scan. Messages are stored first and then
+# numbered, in the order they were stored, by one sequencer per channel
+# at a time: a synchronous single publish if no other is numbering the
+# channel's messages, or else a task (always, for batch and asynchronous
+# publishes, so they aren't held up). The sequencer numbers up to
+# SEQUENCE_BATCH_SIZE messages at a time, and only then moves the
+# channel's visible sequence number on, so readers never see a gap that
+# is still to be filled. Allocating numbers is a transaction, retried up
+# to SEQUENCE_RETRIES times
+SEQUENCE_BATCH_SIZE=50
+SEQUENCE_RETRIES=10
+
+# A subscriber can have a channel's past messages replayed to it, from a
+# sequence number or a point in time. A replay is carried out by a chain
+# of tasks, each of which sends (or, for a pull or batch subscriber,
+# creates the deliveries of) the next REPLAY_BATCH_SIZE messages, so only
+# one batch is in hand at a time however long the replay. A pull or batch
+# subscriber with REPLAY_BATCH_SIZE messages still waiting is given
+# REPLAY_WAIT seconds to catch up before any more are added. A push
+# subscriber is sent its messages one at a time, for up to REPLAY_TIME
+# seconds per task
+REPLAY_BATCH_SIZE=100
+REPLAY_WAIT=30
+REPLAY_TIME=20
+
+# Each channel keeps its messages for up to its maximum age (in seconds)
+# and up to its maximum number of them, or RETENTION_MAX_AGE and
+# RETENTION_MAX_COUNT for a channel without its own (0 meaning no limit).
+# Messages are stored in buckets of MESSAGE_BUCKET_SIZE seconds of
+# publishing, so that a compaction task, run by cron (see cron.yaml),
+# can expire whole buckets at a time, COMPACTION_BATCH_SIZE messages per
+# task. Only messages with no deliveries still to be made or pulled are
+# purged; dead letters are purged with their messages
+MESSAGE_BUCKET_SIZE=3600
+RETENTION_MAX_AGE=0
+RETENTION_MAX_COUNT=0
+COMPACTION_BATCH_SIZE=200
+
 # Statuses
 STATUS_DELIVERED='DELIVERED'
+STATUS_DEADLETTER='DEADLETTER'
+STATUS_BATCHED='BATCHED'
+STATUS_PULL='PULL'
 
 CT_JSON = 'application/json'
+CT_NDJSON = 'application/x-ndjson'
+CT_EVENTSTREAM = 'text/event-stream'
+
+# Number of entities on a page of a list resource, by default
+# and at most (when asked for with a limit parameter)
+PAGE_SIZE=20
+PAGE_SIZE_MAX=100
+
+# Channels and subscribers looked up by id are cached in-process,
+# up to ENTITY_CACHE_SIZE of them for at most ENTITY_CACHE_TTL seconds.
+# The TTL bounds how long another instance's cache can go on serving an
+# entity that this one has deleted
+ENTITY_CACHE_SIZE=1000
+ENTITY_CACHE_TTL=60
+
+# Each channel's list of subscribers is cached in memcache (in chunks of
+# SUBSCRIBER_CACHE_CHUNK subscribers, to keep within the value size limit)
+# and in-process, under a version that is bumped whenever a subscriber is
+# added or deleted. SUBSCRIBER_CACHE_CHANNELS lists are kept in-process
+SUBSCRIBER_CACHE_CHUNK=1000
+SUBSCRIBER_CACHE_CHANNELS=100
+SUBSCRIBER_CACHE_TTL=3600
 
 if DEBUG:
   logging.getLogger().setLevel(logging.DEBUG)
 
+# Page templates, compiled once per process, by name
+TEMPLATE_DIR = os.path.dirname(os.path.abspath(__file__))
+templates = {}
+
+entitycache = LRUCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+subscribercache = LRUCache(SUBSCRIBER_CACHE_CHANNELS, SUBSCRIBER_CACHE_TTL)
+
+# Delivery connection pool, created on first use outside App Engine
+transportpool = None
+
+# Circuit breakers and rate limits, by subscriber host
+hostthrottles = LRUCache(THROTTLE_HOSTS, THROTTLE_TTL)
+
+# Notified whenever a message is published, to wake stream requests
+publishcondition = threading.Condition()
+
 
 def isNumber(n):
   try:
@@ -43,6 +229,794 @@ def isNumber(n):
     pass
 
 
+def acceptsjson(request):
+  """Poor conneg: whether JSON (only) has been asked for"""
+  return (request.headers.has_key('Accept')
+    and request.headers['Accept'] == CT_JSON)
+
+
+def writejson(response, info):
+  """Writes info to the response as JSON"""
+  from django.utils import simplejson
+  response.out.write(simplejson.dumps(info))
+  response.headers['Content-Type'] = CT_JSON
+
+
+def isoformat(timestamp):
+  return timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def gettemplate(name):
+  """Returns the compiled template of the given name, compiling it
+  (and the templates it includes) on first use
+  """
+  from google.appengine.ext.webapp import template
+  compiled = templates.get(name)
+  if compiled is None:
+    compiled = template.load(os.path.join(TEMPLATE_DIR, name))
+    templates[name] = compiled
+  return compiled
+
+
+def rendertemplate(name, template_values):
+  """Renders the named template from its compiled form"""
+  from google.appengine.ext.webapp import template
+  return gettemplate(name).render(template.Context(template_values))
+
+
+def warmtemplates():
+  """Compiles all the page templates (but not the *_incl.html fragments,
+  which are compiled into the pages that include them), so that no
+  request has to. Returns the number of templates compiled.
+  """
+  started = time.time()
+  names = [name for name in os.listdir(TEMPLATE_DIR)
+           if name.endswith('.html') and not name.endswith('_incl.html')
+           and name != 'docu.html']
+  for name in names:
+    gettemplate(name)
+  logging.info("Compiled %d templates in %.3fs" % (len(names), time.time() - started))
+  return len(names)
+
+
+def getcachedentity(type, id):
+  """Read-through lookup of the entity of the given type and (numeric) id
+  """
+  key = (type.kind(), id)
+  entity = entitycache.get(key)
+  if entity is None:
+    entity = type.get_by_id(id)
+    if entity is not None:
+      entitycache.set(key, entity)
+  return entity
+
+
+def uncacheentity(entity):
+  """Removes an entity from the entity cache, on its creation or deletion"""
+  entitycache.delete((entity.kind(), entity.key().id()))
+
+
+def prefetchrefs(entities, *properties):
+  """Resolves the given reference properties of each of the entities
+  with a single batch get, so that dereferencing them afterwards (e.g.
+  row by row in a template) doesn't cost a datastore get each time.
+  Returns the referenced entities that exist, by key.
+  """
+  keys = {}
+  for entity in entities:
+    for prop in properties:
+      key = prop.get_value_for_datastore(entity)
+      if key is not None:
+        keys[key] = True
+  keys = keys.keys()
+  referenced = {}
+  for key, entity in zip(keys, db.get(keys)):
+    if entity is not None:
+      referenced[key] = entity
+  for entity in entities:
+    for prop in properties:
+      key = prop.get_value_for_datastore(entity)
+      if key in referenced:
+        setattr(entity, prop.name, referenced[key])
+  return referenced
+
+
+def subscriberlist(channelkey):
+  """Returns the channel's subscribers as a list of (subscriber key,
+  resource, batch size, batch wait, mode) tuples, in the order they were
+  created. Read through the in-process and memcache subscriber list caches.
+  """
+  versionkey = 'subscribers-version:%s' % (channelkey, )
+  version = memcache.get(versionkey)
+  if version is None:
+    # Start from a fresh version, so that lists cached under any
+    # version there was before (and has since been evicted) are not used
+    version = int(time.time() * 1000)
+    if not memcache.add(versionkey, version):
+      version = memcache.get(versionkey) or version
+  listkey = 'channelsubscribers:%s:%s' % (channelkey, version)
+
+  subscribers = subscribercache.get(listkey)
+  if subscribers is not None:
+    return subscribers
+
+  nrchunks = memcache.get(listkey)
+  if nrchunks is not None:
+    chunkkeys = ['%s:%d' % (listkey, chunk) for chunk in range(nrchunks)]
+    chunks = memcache.get_multi(chunkkeys)
+    if len(chunks) == nrchunks:
+      subscribers = []
+      for chunkkey in chunkkeys:
+        subscribers.extend(chunks[chunkkey])
+      subscribercache.set(listkey, subscribers)
+      return subscribers
+
+  subscribers = []
+  query = Subscriber.all().filter('channel =', channelkey).order('created')
+  while True:
+    results = query.fetch(SUBSCRIBER_CACHE_CHUNK)
+    subscribers.extend([(subscriber.key(), subscriber.resource, subscriber.batchsize or 0,
+                         subscriber.batchwait or 0, subscriber.mode or MODE_PUSH)
+                        for subscriber in results])
+    if len(results) < SUBSCRIBER_CACHE_CHUNK:
+      break
+    query.with_cursor(query.cursor())
+
+  chunks = {}
+  for start in range(0, len(subscribers), SUBSCRIBER_CACHE_CHUNK):
+    chunks['%s:%d' % (listkey, len(chunks))] = subscribers[start:start + SUBSCRIBER_CACHE_CHUNK]
+  memcache.set_multi(chunks, time=SUBSCRIBER_CACHE_TTL)
+  memcache.set(listkey, len(chunks), time=SUBSCRIBER_CACHE_TTL)
+  subscribercache.set(listkey, subscribers)
+  return subscribers
+
+
+def uncachesubscribers(channelkey):
+  """Invalidates the cached subscriber list for a channel, on a
+  subscriber being added or deleted
+  """
+  memcache.incr('subscribers-version:%s' % (channelkey, ))
+
+
+def timedelta_seconds(delta):
+  """Total number of seconds in a timedelta"""
+  return delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0
+
+
+def createdeliveries(message, subscriberkeys, batchsize=DELIVERY_BATCH_SIZE,
+                     shardsize=DISTRIBUTION_SHARD_SIZE):
+  """Creates a Delivery of the message for each of the subscriber keys.
+  The deliveries are written batchsize at a time, so the number of
+  datastore round trips depends on the batch size rather than on the
+  number of subscribers. Each delivery is assigned to a distribution
+  shard of at most shardsize deliveries, and is keyed by message and
+  subscriber. Those that already exist, from an earlier attempt at the
+  fan-out, are left as they are, so that a retry neither duplicates them
+  nor undoes what has been delivered since. Returns the number of
+  deliveries.
+  """
+  now = datetime.datetime.now()
+  for start in range(0, len(subscriberkeys), batchsize):
+    indexes = range(start, min(start + batchsize, len(subscriberkeys)))
+    names = [Delivery.deliveryname(message.key(), subscriberkeys[index]) for index in indexes]
+    deliveries = []
+    for index, name, existing in zip(indexes, names, Delivery.get_by_key_name(names)):
+      if existing is None:
+        deliveries.append(Delivery(
+          key_name = name,
+          message = message,
+          recipient = subscriberkeys[index],
+          shard = index / shardsize,
+          nextattempt = now,
+        ))
+    if deliveries:
+      db.put(deliveries)
+  return len(subscriberkeys)
+
+
+def createdeliveryshards(message, subscriberkeys, batchsize=DELIVERY_BATCH_SIZE,
+                         shardsize=DISTRIBUTION_SHARD_SIZE):
+  """The compact equivalent of createdeliveries(), for a message on a
+  compact channel: creates a DeliveryShard for each distribution shard's
+  worth of the subscriber keys, rather than a Delivery per subscriber.
+  As with createdeliveries(), shards that already exist are left as they
+  are, bitmaps and all. Returns the number of deliveries to be made.
+  """
+  nrshards = countshards(len(subscriberkeys), shardsize)
+  for start in range(0, nrshards, batchsize):
+    shardnums = range(start, min(start + batchsize, nrshards))
+    names = [DeliveryShard.shardname(message.key(), shard) for shard in shardnums]
+    shards = []
+    for shard, existing in zip(shardnums, DeliveryShard.get_by_key_name(names)):
+      if existing is None:
+        shards.append(DeliveryShard.create(message, shard,
+          subscriberkeys[shard * shardsize:(shard + 1) * shardsize]))
+    if shards:
+      db.put(shards)
+  return len(subscriberkeys)
+
+
+def deliveryreport(message):
+  """Returns the state of each of a message's deliveries, as a list of
+  dicts of recipient key, status and updated timestamp. For a message on
+  a compact channel these come from its delivery shards, and from the
+  Delivery of each recipient that has failed.
+  """
+  if not message.compact:
+    return [{
+      'recipientkey': Delivery.recipient.get_value_for_datastore(d),
+      'status': d.status,
+      'updated': d.updated,
+    } for d in Delivery.all().filter('message =', message)]
+
+  failures = {}
+  for delivery in Delivery.all().filter('message =', message):
+    failures[Delivery.recipient.get_value_for_datastore(delivery)] = delivery
+  shardnames = [DeliveryShard.shardname(message.key(), shard) for shard in range(message.shards or 0)]
+  report = []
+  for deliveryshard in DeliveryShard.get_by_key_name(shardnames):
+    if deliveryshard is None:
+      continue
+    for index, key in enumerate(deliveryshard.recipientkeys()):
+      if deliveryshard.isfailed(index) and key in failures:
+        status, updated = failures[key].status, failures[key].updated
+      elif deliveryshard.isdelivered(index):
+        status, updated = STATUS_DELIVERED, deliveryshard.updated
+      else:
+        status, updated = None, deliveryshard.updated
+      report.append({ 'recipientkey': key, 'status': status, 'updated': updated })
+  return report
+
+
+def fanout(message):
+  """Creates the deliveries of a newly published message, one for each
+  of its channel's subscribers, and kicks off their distribution. Returns
+  the number of deliveries.
+  """
+  # Only the subscriber keys are needed to set up the deliveries,
+  # and these are written in batches rather than one by one
+  channelkey = Message.channel.get_value_for_datastore(message)
+  subscriberkeys = [subscriber[0] for subscriber in subscriberlist(channelkey)]
+  if message.compact:
+    nrdeliveries = createdeliveryshards(message, subscriberkeys)
+  else:
+    nrdeliveries = createdeliveries(message, subscriberkeys)
+  if nrdeliveries:
+    # Kick off the tasks to distribute message, and only then record
+    # the number of recipients, and of the shards whose counters will
+    # hold the number of deliveries made. A fan-out task that fails
+    # before the shards are recorded is retried in full, rather than
+    # taking the message to be fanned out already. The retry keeps the
+    # deliveries and tasks made the first time, so nothing is sent or
+    # counted twice
+    nrshards = countshards(nrdeliveries)
+    enqueuedistribution(message, nrshards)
+    updatemessage(message, recipients=nrdeliveries, shards=nrshards)
+
+    logging.debug("Delivery queued for %d subscribers of channel %s in %d shards" % (nrdeliveries, channelkey.id(), nrshards))
+  else:
+    logging.debug("No subscribers for channel %s" % (channelkey.id(), ))
+  return nrdeliveries
+
+
+def messagebucket(timestamp):
+  """The storage bucket of messages published at the given time"""
+  return int(timedelta_seconds(timestamp - datetime.datetime(1970, 1, 1)) / MESSAGE_BUCKET_SIZE)
+
+
+def retention(channel):
+  """The channel's maximum message age (in seconds) and number of
+  messages, either of which may be 0 for no limit
+  """
+  maxage, maxcount = channel.maxage, channel.maxcount
+  if maxage is None:
+    maxage = RETENTION_MAX_AGE
+  if maxcount is None:
+    maxcount = RETENTION_MAX_COUNT
+  return maxage, maxcount
+
+
+def outstanding(message):
+  """Whether any of the message's deliveries are still to be made or
+  pulled, including, for a compact message, first attempts not yet
+  made from its shards
+  """
+  for status in (None, STATUS_BATCHED, STATUS_PULL):
+    query = Delivery.all(keys_only=True).filter('message =', message).filter('status =', status)
+    if query.get() is not None:
+      return True
+  if message.compact:
+    names = [DeliveryShard.shardname(message.key(), shard) for shard in range(message.shards or 0)]
+    for deliveryshard in DeliveryShard.get_by_key_name(names):
+      if deliveryshard is None:
+        continue
+      for index in range(len(deliveryshard.recipients) / 8):
+        if not (deliveryshard.isdelivered(index) or deliveryshard.isfailed(index)):
+          return True
+  return False
+
+
+def purgemessages(messages):
+  """Deletes those of the messages that have no deliveries outstanding,
+  along with their deliveries, delivery counters and delivery shards,
+  DELIVERY_BATCH_SIZE entities per datastore round trip. A dead-lettered
+  delivery is as final as a delivered one here, so a message's dead
+  letters expire with it. Returns the number of messages deleted.
+  """
+  done = [message for message in messages if not outstanding(message)]
+  keys = []
+  def flush(keys, final=False):
+    while len(keys) >= DELIVERY_BATCH_SIZE or (final and keys):
+      db.delete(keys[:DELIVERY_BATCH_SIZE])
+      del keys[:DELIVERY_BATCH_SIZE]
+
+  for message in done:
+    query = Delivery.all(keys_only=True).filter('message =', message)
+    while True:
+      deliverykeys = query.fetch(DELIVERY_BATCH_SIZE)
+      keys.extend(deliverykeys)
+      flush(keys)
+      if len(deliverykeys) < DELIVERY_BATCH_SIZE:
+        break
+      query.with_cursor(query.cursor())
+    for shard in range(message.shards or 0):
+      keys.append(db.Key.from_path('DeliveryCounter', DeliveryCounter.countername(message.key(), shard)))
+      if message.compact:
+        keys.append(db.Key.from_path('DeliveryShard', DeliveryShard.shardname(message.key(), shard)))
+    keys.append(message.key())
+    flush(keys)
+  flush(keys, True)
+  return len(done)
+
+
+def countshards(nrdeliveries, shardsize=DISTRIBUTION_SHARD_SIZE):
+  """Number of distribution shards needed for nrdeliveries"""
+  return (nrdeliveries + shardsize - 1) / shardsize
+
+
+def enqueuedistribution(message, nrshards):
+  """Kicks off the distribution of a message with one task per
+  shard of its deliveries, so the shards are distributed in parallel
+  and retried independently of each other. The tasks are named by
+  message and shard, so kicking off the same distribution again (from a
+  retried fan-out) adds none that have been added already.
+  """
+  from google.appengine.api.labs import taskqueue
+  def task(shard):
+    return taskqueue.Task(url='/distributor/%s/%d' % (message.key(), shard),
+                          name='distribute-%s-%d' % (message.key(), shard))
+  try:
+    addtasks([task(shard) for shard in range(nrshards)])
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    # Some were added before; add the rest one by one
+    for shard in range(nrshards):
+      try:
+        task(shard).add(QUEUE_DISTRIBUTION)
+      except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def addtasks(tasks, queuename=QUEUE_DISTRIBUTION):
+  """Adds tasks to the named queue in as few calls as possible"""
+  from google.appengine.api.labs import taskqueue
+  queue = taskqueue.Queue(queuename)
+  while tasks:
+    queue.add(tasks[:taskqueue.MAX_TASKS_PER_ADD])
+    tasks = tasks[taskqueue.MAX_TASKS_PER_ADD:]
+
+
+def allocateseqs(channelkey, count=1):
+  """Allocates the next count of the channel's message sequence numbers,
+  returning the first of them
+  """
+  def txn():
+    sequencename = ChannelSequence.sequencename(channelkey)
+    sequence = ChannelSequence.get_by_key_name(sequencename)
+    if sequence is None:
+      sequence = ChannelSequence(key_name=sequencename)
+    first = sequence.last + 1
+    sequence.last += count
+    sequence.put()
+    return first
+  return db.run_in_transaction_custom_retries(SEQUENCE_RETRIES, txn)
+
+
+def showseqs(channelkey, seq):
+  """Makes the channel's messages up to sequence number seq visible"""
+  def txn():
+    sequence = ChannelSequence.get_by_key_name(ChannelSequence.sequencename(channelkey))
+    if sequence.visible < seq:
+      sequence.visible = seq
+      sequence.put()
+  db.run_in_transaction_custom_retries(SEQUENCE_RETRIES, txn)
+
+
+def lastseq(channelkey):
+  """The last sequence number visible on the channel, i.e. that of its
+  latest message, all those before which have been numbered
+  """
+  sequence = ChannelSequence.get_by_key_name(ChannelSequence.sequencename(channelkey))
+  if sequence is None:
+    return 0
+  # Sequences from before visible numbers were kept have none
+  return sequence.visible or sequence.last
+
+
+def updatemessage(message, **values):
+  """Sets properties of a stored message in a transaction, so as not to
+  overwrite any set at the same time by another writer (its fan-out
+  and its sequencer each set their own), and on message itself
+  """
+  def txn():
+    stored = Message.get(message.key())
+    for name, value in values.items():
+      setattr(stored, name, value)
+    stored.put()
+  db.run_in_transaction(txn)
+  for name, value in values.items():
+    setattr(message, name, value)
+
+
+def sequencemessages(channelkey):
+  """Numbers the channel's messages that have no sequence number yet, in
+  the order they were stored, and makes them visible. Only to be called
+  by the channel's one sequencer. Returns the number of messages numbered.
+  """
+  numbered = 0
+  query = Message.all().filter('channel =', channelkey).filter('seq =', None).order('created')
+  while True:
+    messages = query.fetch(SEQUENCE_BATCH_SIZE)
+    if not messages:
+      break
+    first = allocateseqs(channelkey, len(messages))
+    for index, message in enumerate(messages):
+      def txn(key=message.key(), seq=first + index):
+        stored = Message.get(key)
+        if stored is not None and stored.seq is None:
+          stored.seq = seq
+          stored.put()
+      db.run_in_transaction(txn)
+    showseqs(channelkey, first + len(messages) - 1)
+    numbered += len(messages)
+    if len(messages) < SEQUENCE_BATCH_SIZE:
+      break
+  if numbered:
+    notifypublished(channelkey)
+  return numbered
+
+
+def enqueuesequencer(channelkey, delay=1):
+  """Makes sure a sequencer task will number the channel's newly stored
+  messages. It is due no sooner than the next second, because a task
+  named for this second may be running and already past looking for
+  messages, whereas one named for a later second can't have started yet
+  """
+  enqueuedue('/sequencer/%d' % (channelkey.id(), ), 'seq-%d' % (channelkey.id(), ),
+             time.time() + delay)
+
+
+def unsequenced(channelkey):
+  """Whether any of the channel's messages are still to be numbered"""
+  query = Message.all(keys_only=True).filter('channel =', channelkey).filter('seq =', None)
+  return query.get() is not None
+
+
+def sequence(channelkey):
+  """Numbers the channel's newly stored messages now, unless another
+  sequencer already is, or fails to, in which case a sequencer task is
+  made sure of
+  """
+  lease = 'seq-%d' % (channelkey.id(), )
+  if not acquirelease(lease):
+    enqueuesequencer(channelkey)
+    return
+  try:
+    try:
+      sequencemessages(channelkey)
+    except:
+      logging.exception("Numbering messages of channel %s failed, leaving it to a task" % (channelkey.id(), ))
+      enqueuesequencer(channelkey, WORKER_LEASE_RETRY)
+  finally:
+    releaselease(lease)
+
+
+def countdelivered(messagekey, shard, delivered):
+  """Adds to the delivered counter for a distribution shard of a message"""
+  def txn():
+    countername = DeliveryCounter.countername(messagekey, shard)
+    counter = DeliveryCounter.get_by_key_name(countername)
+    if counter is None:
+      counter = DeliveryCounter(key_name=countername)
+    counter.delivered += delivered
+    counter.put()
+  db.run_in_transaction(txn)
+
+
+def deliverycounts(messages):
+  """Returns a list of the number of deliveries made so far for each
+  of the messages, read from their counters with a single batch get
+  """
+  keys = []
+  for message in messages:
+    for shard in range(message.shards or 0):
+      keys.append(db.Key.from_path('DeliveryCounter', DeliveryCounter.countername(message.key(), shard)))
+  delivered = {}
+  for counter in db.get(keys):
+    if counter is not None:
+      messagekey = counter.key().name().split(':')[0]
+      delivered[messagekey] = delivered.get(messagekey, 0) + counter.delivered
+  return [delivered.get(str(message.key()), 0) for message in messages]
+
+
+def backoff(attempts, base=DELIVERY_BACKOFF_BASE, maximum=DELIVERY_BACKOFF_MAX):
+  """Returns the number of seconds to wait before retrying a delivery
+  that has failed attempts times: exponential in the number of attempts,
+  capped at maximum, and jittered to somewhere between half and all of that
+  """
+  delay = min(maximum, base * 2 ** max(attempts - 1, 0))
+  return random.uniform(delay / 2.0, delay)
+
+
+def recordattempt(delivery, status, now, delay=0):
+  """Records an attempt at a delivery that got the given HTTP status:
+  a successful status makes it delivered, otherwise it is scheduled
+  for another attempt, no sooner than delay seconds from now, or
+  dead-lettered if it has run out of attempts or time. A status of None
+  means the delivery was held back by its host's throttle, so it isn't
+  counted as an attempt, just put off for delay seconds.
+  Returns whether it was delivered.
+  """
+  if status is None:
+    delivery.nextattempt = now + datetime.timedelta(seconds=delay)
+    return False
+  delivery.attempts = (delivery.attempts or 0) + 1
+  if status < 400:
+    delivery.status = STATUS_DELIVERED
+    return True
+  if (delivery.attempts >= DELIVERY_MAX_ATTEMPTS
+    or (delivery.created and now - delivery.created > DELIVERY_MAX_AGE)):
+    logging.info("Delivery of %s to %s dead-lettered after %d attempts" % (
+      Delivery.message.get_value_for_datastore(delivery),
+      Delivery.recipient.get_value_for_datastore(delivery), delivery.attempts))
+    delivery.status = STATUS_DEADLETTER
+  else:
+    delivery.nextattempt = now + datetime.timedelta(seconds=max(backoff(delivery.attempts), delay))
+  return False
+
+
+def enqueuedue(url, prefix, due):
+  """Makes sure a task for url is queued to run at due (in seconds since
+  the epoch). Tasks are named by prefix and due second, so work falling
+  due in the same second gets one task, and chains of tasks re-queueing
+  themselves for the same time merge into one. If the task of that name
+  has already run, the next second is used.
+  """
+  from google.appengine.api.labs import taskqueue
+  due = int(due)
+  while True:
+    try:
+      taskqueue.Task(url=url, name='%s-%d' % (prefix, due),
+                     countdown=max(0, due - int(time.time()))).add(QUEUE_DISTRIBUTION)
+      return
+    except taskqueue.TaskAlreadyExistsError:
+      return
+    except taskqueue.TombstonedTaskError:
+      due += 1
+
+
+def enqueuedistributor(messagekey, shard=None, due=None):
+  """Makes sure a distribution task for the message (or one shard of it)
+  is queued to run at due, or now, named by due time
+  """
+  if shard is None:
+    url, prefix = '/distributor/%s' % (messagekey, ), 'dist-%s' % (messagekey, )
+  else:
+    url, prefix = '/distributor/%s/%d' % (messagekey, int(shard)), 'dist-%s-%d' % (messagekey, int(shard))
+  enqueuedue(url, prefix, due or time.time())
+
+
+def acquirelease(name):
+  """Takes the named worker lease, returning whether it was free"""
+  return memcache.add('lease:%s' % (name, ), 1, time=WORKER_LEASE)
+
+
+def releaselease(name):
+  memcache.delete('lease:%s' % (name, ))
+
+
+def enqueuebatchdelivery(subscriberkey, batchwait, now=False):
+  """Makes sure a batch delivery task is on its way for a subscriber that
+  takes its messages in batches: one that runs straight away if now is
+  set (or there is no batch wait), or else one that runs batchwait seconds
+  from now. The former are named by due time, like the worker's own
+  re-queues, and the latter by batch wait window, so there is just one
+  of them per subscriber per window, however many deliveries are handed
+  over in it.
+  """
+  from google.appengine.api.labs import taskqueue
+  url = '/batcher/%d' % (subscriberkey.id(), )
+  if now or not batchwait:
+    enqueuedue(url, 'batch-%d' % (subscriberkey.id(), ), time.time())
+    return
+  name = 'batch-%d-%d-%d' % (subscriberkey.id(), batchwait, int(time.time() / batchwait))
+  try:
+    taskqueue.Task(url=url, name=name, countdown=batchwait).add(QUEUE_DISTRIBUTION)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def enqueuereplay(subscriberid, replayid, step, after, upto, attempts=0, countdown=0):
+  """Queues the next task in the chain replaying a subscriber's channel's
+  messages after sequence number after (up to upto) to it. Tasks are
+  named by replay and step, so a task that is retried having already
+  queued its successor doesn't fork the chain.
+  """
+  from google.appengine.api.labs import taskqueue
+  try:
+    taskqueue.Task(
+      url = '/replayer/%s' % (subscriberid, ),
+      name = 'replay-%s-%s-%d' % (subscriberid, replayid, step),
+      params = { 'replay': replayid, 'step': step, 'after': after, 'upto': upto, 'attempts': attempts },
+      countdown = int(countdown),
+    ).add(QUEUE_DISTRIBUTION)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def batchitem(message):
+  """A message as an element of a batch delivery: its key, sequence
+  number, content type, creation time and body, the body as text if it
+  is UTF-8, and base64 encoded otherwise
+  """
+  item = {
+    'key': str(message.key()),
+    'seq': message.seq,
+    'contenttype': message.contenttype,
+    'created': isoformat(message.created),
+  }
+  body = message.body or ''
+  try:
+    item['body'] = body.decode('utf-8')
+  except UnicodeError:
+    item['body'] = base64.b64encode(body)
+    item['encoding'] = 'base64'
+  return item
+
+
+def publishmarker(channelkey):
+  """The channel's publish marker, which changes whenever a message is
+  published to it
+  """
+  return memcache.get('published:%s' % (channelkey, ))
+
+
+def notifypublished(channelkey):
+  """Wakes up the stream requests waiting on a channel, after a message
+  has been published to it: those in this process directly, and those in
+  others by changing the channel's publish marker
+  """
+  key = 'published:%s' % (channelkey, )
+  if memcache.incr(key) is None:
+    memcache.add(key, 1)
+  publishcondition.acquire()
+  try:
+    publishcondition.notifyAll()
+  finally:
+    publishcondition.release()
+
+
+def waitforpublish(channelkey, marker, timeout):
+  """Waits up to timeout seconds for the channel's publish marker to
+  change from marker, returning the marker as it then is
+  """
+  deadline = time.time() + timeout
+  while True:
+    now = time.time()
+    if now >= deadline:
+      return marker
+    publishcondition.acquire()
+    try:
+      publishcondition.wait(min(STREAM_POLL_INTERVAL, deadline - now))
+    finally:
+      publishcondition.release()
+    current = publishmarker(channelkey)
+    if current != marker:
+      return current
+
+
+def onappengine():
+  """Whether we're running on App Engine (or its development server),
+  i.e. in the urlfetch sandbox
+  """
+  software = os.environ.get('SERVER_SOFTWARE', '')
+  return software.startswith('Google App Engine') or software.startswith('Development')
+
+
+def hostthrottle(url):
+  """The circuit breaker and rate limit for deliveries to url's host"""
+  host = urlparse.urlsplit(url or '')[1].lower()
+  throttle = hostthrottles.get(host)
+  if throttle is None:
+    throttle = HostThrottle(THROTTLE_FAILURES, THROTTLE_OPEN_TIME, THROTTLE_OPEN_MAX,
+                            THROTTLE_MAX_RATE, THROTTLE_MIN_RATE)
+    hostthrottles.set(host, throttle)
+  return throttle
+
+
+def retrydelay(url):
+  """Number of seconds until a delivery may next be made to url's host"""
+  return hostthrottle(url).delay()
+
+
+def postconcurrently(requests, concurrency=DELIVERY_CONCURRENCY, timeout=DELIVERY_TIMEOUT):
+  """Makes a POST for each (url, payload, headers) tuple in requests
+  that gets past the circuit breaker and rate limit for its host, with
+  at most concurrency of them in flight at any time, each one given
+  timeout seconds to complete. Returns a list of HTTP status codes in the
+  same order as requests; a request that fails to complete at all gets a
+  status of 999, and one that was held back gets None (see retrydelay()
+  for when to try it again).
+  """
+  throttles = [hostthrottle(url) for url, payload, headers in requests]
+  allowed = [index for index in range(len(requests)) if throttles[index].acquire()]
+  statuses = [None] * len(requests)
+  if allowed:
+    results = fetchall([requests[index] for index in allowed], concurrency, timeout)
+    for index, (status, retryafter) in zip(allowed, results):
+      throttles[index].record(status, retryafter)
+      statuses[index] = status
+  return statuses
+
+
+def fetchall(requests, concurrency, timeout):
+  """Makes a POST for each (url, payload, headers) tuple in requests
+  using asynchronous urlfetch calls, with at most concurrency of them
+  in flight at any time, each one given timeout seconds to complete.
+  Outside App Engine the POSTs are made over the pooled connections of
+  the delivery transport instead.
+  Returns a list of (HTTP status, Retry-After) tuples in the same order
+  as requests; a request that fails to complete at all gets a status of 999.
+  """
+  global transportpool
+  if not onappengine():
+    if transportpool is None:
+      import transport
+      transportpool = transport.ConnectionPool(TRANSPORT_MAX_PER_HOST, TRANSPORT_IDLE_TIMEOUT, timeout)
+    return transportpool.postall(requests, concurrency)
+
+  from google.appengine.api import urlfetch
+  results = [(999, None)] * len(requests)
+
+  def collect(index, rpc):
+    try:
+      result = rpc.get_result()
+      results[index] = (result.status_code, result.headers.get('Retry-After'))
+    except:
+      logging.error("urlfetch encountered an EXCEPTION for %s" % (requests[index][0], ))
+
+  inflight = []
+  for index, (url, payload, headers) in enumerate(requests):
+    # Wait for the oldest call to finish before starting another one
+    # if we're at the concurrency limit
+    if len(inflight) >= concurrency:
+      collect(*inflight.pop(0))
+    rpc = urlfetch.create_rpc(deadline=timeout)
+    try:
+      urlfetch.make_fetch_call(rpc, url,
+        payload = payload,
+        method = urlfetch.POST,
+        headers = headers,
+        follow_redirects = False,
+      )
+    except:
+      logging.error("urlfetch could not start a call to %s" % (url, ))
+      continue
+    inflight.append((index, rpc))
+  for index, rpc in inflight:
+    collect(index, rpc)
+  return results
+
+
 class EntityRequestHandler(webapp.RequestHandler):
   """Base RequestHandler supplying common methods
   for retrieving entities such as channels and subscribers
@@ -62,7 +1036,7 @@ class EntityRequestHandler(webapp.RequestHandler):
       self.response.set_status(404)
       return
 
-    entity = type.get_by_id(int(id))
+    entity = getcachedentity(type, id)
     if entity is None:
       self.response.out.write("%s %s not found" % (type.__name__, id))
       self.response.set_status(404)
@@ -70,6 +1044,48 @@ class EntityRequestHandler(webapp.RequestHandler):
 
     return entity
 
+  def _fetchpage(self, query):
+    """Fetches the page of query results given by the cursor and limit
+    parameters of the request. Returns the results and a dict of links
+    to the next, previous and first pages (None where there is no such
+    page), or None, having set a 400, if the cursor is not valid.
+    Previous links only go back one page, as datastore cursors only
+    go forwards.
+    """
+    limit = PAGE_SIZE
+    if isNumber(self.request.get('limit')):
+      limit = max(1, min(int(self.request.get('limit')), PAGE_SIZE_MAX))
+    cursor = self.request.get('cursor')
+    try:
+      if cursor:
+        query.with_cursor(cursor)
+      results = query.fetch(limit)
+    except (db.BadValueError, db.BadRequestError):
+      self.response.out.write("Invalid cursor %s" % (cursor, ))
+      self.response.set_status(400)
+      return
+
+    def pageurl(**params):
+      if self.request.get('limit'):
+        params['limit'] = limit
+      for name in self.request.arguments():
+        if name not in ('cursor', 'prev', 'limit'):
+          params[name] = self.request.get(name)
+      if not params:
+        return self.request.path_url
+      return "%s?%s" % (self.request.path_url, urllib.urlencode(params))
+
+    paging = { 'next': None, 'prev': None, 'first': None }
+    if len(results) == limit:
+      paging['next'] = pageurl(cursor=query.cursor(), prev=cursor)
+    if cursor:
+      paging['first'] = pageurl()
+      if self.request.get('prev'):
+        paging['prev'] = pageurl(cursor=self.request.get('prev'))
+      elif 'prev' in self.request.arguments():
+        paging['prev'] = paging['first']
+    return results, paging
+
 
 
 class MainPageHandler(webapp.RequestHandler):
@@ -78,29 +1094,58 @@ class MainPageHandler(webapp.RequestHandler):
       'version': VERSION,
       'server_software': os.environ.get("SERVER_SOFTWARE", "unknown"),
     }
-    path = os.path.join(os.path.dirname(__file__), 'index.html')
-    self.response.out.write(template.render(path, template_values))
+    self.response.out.write(rendertemplate('index.html', template_values))
+
+class WarmupHandler(webapp.RequestHandler):
+  """Handles App Engine warmup requests, i.e. /_ah/warmup,
+  getting a new instance ready before it is sent any real requests
+  """
+  def get(self):
+    warmtemplates()
 
-class ChannelContainerHandler(webapp.RequestHandler):
+
+class ChannelContainerHandler(EntityRequestHandler):
   """Handler for main /channel/ resource
   """
   def get(self):
-    """Show list of channels
+    """Show a page of channels
     """
-#   TODO: paging
+    page = self._fetchpage(Channel.all().order('-created'))
+    if page is None: return
+    results, paging = page
+
     channels = []
-    for channel in db.GqlQuery("SELECT * FROM Channel ORDER BY created DESC"):
+    for channel in results:
       channels.append({
         'channelid': channel.key().id(),
         'name': channel.name,
+        'compact': channel.compact,
+        'maxage': channel.maxage,
+        'maxcount': channel.maxcount,
         'created': channel.created,
         'created_ago': agoify(channel.created),
       })
+
+    if acceptsjson(self.request):
+      info = {
+        'channels': [{
+          'resource': "%s/channel/%d/" % (self.request.host_url, c['channelid']),
+          'name': c['name'],
+          'compact': c['compact'],
+          'maxage': c['maxage'],
+          'maxcount': c['maxcount'],
+          'created': isoformat(c['created']),
+        } for c in channels],
+        'paging': paging,
+      }
+      writejson(self.response, info)
+      return
+
     template_values = {
       'channels': channels,
+      'paging': paging,
     }
-    path = os.path.join(os.path.dirname(__file__), 'channel_list.html')
-    self.response.out.write(template.render(path, template_values))
+    self.response.out.write(rendertemplate('channel_list.html', template_values))
 
   def post(self):
     """Handles a POST to the /channel/ resource
@@ -110,11 +1155,21 @@ class ChannelContainerHandler(webapp.RequestHandler):
     channel = Channel()
     name = self.request.get('name').rstrip('\n')
     channel.name = name
+    # A compact channel keeps the delivery state of its messages in
+    # per-shard bitmaps rather than in a Delivery per subscriber
+    channel.compact = self.request.get('compact') in ('1', 'true', 'on')
+    # Retention, by age in seconds and by number of messages, where
+    # given, overrides the defaults
+    if isNumber(self.request.get('maxage')):
+      channel.maxage = max(0, int(self.request.get('maxage')))
+    if isNumber(self.request.get('maxcount')):
+      channel.maxcount = max(0, int(self.request.get('maxcount')))
     channel.put()
 #   Not sure I like this ... re-put()ing
     if len(channel.name) == 0:
       channel.name = 'channel-' + str(channel.key().id())
       channel.put()
+    uncacheentity(channel)
 
     # If we've got here from a web form, redirect the user to the 
     # channel list, otherwise return the 201
@@ -133,8 +1188,7 @@ class ChannelSubmissionformHandler(webapp.RequestHandler):
     """Renders channel submission form, that has a POST action to
     the /channel/ resource
     """
-    path = os.path.join(os.path.dirname(__file__), 'channelsubmissionform.html')
-    self.response.out.write(template.render(path, {}))
+    self.response.out.write(rendertemplate('channelsubmissionform.html', {}))
 
 
 class ChannelHandler(EntityRequestHandler):
@@ -153,8 +1207,7 @@ class ChannelHandler(EntityRequestHandler):
       'channel': channel,
       'anysubscribers': anysubscribers,
     }
-    path = os.path.join(os.path.dirname(__file__), 'channel_detail.html')
-    self.response.out.write(template.render(path, template_values))
+    self.response.out.write(rendertemplate('channel_detail.html', template_values))
 
   # The publish bit!
   def post(self, channelid):
@@ -162,6 +1215,12 @@ class ChannelHandler(EntityRequestHandler):
     channel = self._getentity(Channel, channelid)
     if channel is None: return
 
+    # The batch flag is only taken from the query string, as a form
+    # encoded message could well have a batch field of its own
+    if self.request.GET.get('batch'):
+      self._publishbatch(channel)
+      return
+
     contenttype = self.request.headers['Content-Type']
 
     # Save message
@@ -169,29 +1228,22 @@ class ChannelHandler(EntityRequestHandler):
       contenttype = contenttype,
       body = self.request.body,
       channel = channel,
+      compact = channel.compact,
+      bucket = messagebucket(datetime.datetime.now()),
     )
     message.put()
 
-#   for subscriber in Subscriber.all().filter('channel =', channel):
-    subscribers = Subscriber.all().filter('channel =', channel)
-    if subscribers.count():
-      for subscriber in subscribers:
-  
-        # Set up delivery of message to subscriber
-        delivery = Delivery(
-          message = message,
-          recipient = subscriber,
-        )
-        delivery.put()
-  
-      # Kick off a task to distribute message
-      taskqueue.Task(
-        url='/distributor/' + str(message.key())
-      ).add(QUEUE_DISTRIBUTION)
-
-      logging.debug("Delivery queued for %d subscribers of channel %s" % (subscribers.count(), channelid))
+    # Number and fan out the message, either now or, for an asynchronous
+    # publish, in tasks, so that the publisher isn't kept waiting
+    # however many subscribers the channel has
+    publishasync = PUBLISH_ASYNC or 'respond-async' in self.request.headers.get('Prefer', '')
+    if publishasync:
+      from google.appengine.api.labs import taskqueue
+      enqueuesequencer(channel.key())
+      taskqueue.Task(url='/fanout/%s' % (message.key(), )).add(QUEUE_DISTRIBUTION)
     else:
-      logging.debug("No subscribers for channel %s" % (channelid, ))
+      sequence(channel.key())
+      fanout(message)
 
     # TODO should we return a 202 instead of a 302?
     # Actually I think it's just a 201, as we've created a new (message) resource
@@ -201,9 +1253,61 @@ class ChannelHandler(EntityRequestHandler):
     self.response.headers['Location'] = self.request.url + "message/%s" % str(message.key())
     if contenttype == "application/x-www-form-urlencoded" and self.request.get('messagesubmissionform') == "coffeeshop":
       self.response.set_status(302)
+    elif publishasync:
+      self.response.set_status(202)
     else:
       self.response.set_status(201)
 
+  def _publishbatch(self, channel):
+    """Publishes a batch of messages to the channel. A batch is either a
+    JSON array, each element of which is a JSON message, or has a message
+    per line (each a JSON message, if the batch is NDJSON). The messages
+    are stored together, their fan-out is queued together, and the
+    response lists their locations, with a 202.
+    """
+    from django.utils import simplejson
+    from google.appengine.api.labs import taskqueue
+    contenttype = self.request.headers.get('Content-Type', '').split(';')[0].strip()
+    if contenttype == CT_JSON:
+      try:
+        bodies = simplejson.loads(self.request.body)
+      except ValueError:
+        bodies = None
+      if not isinstance(bodies, list):
+        self.response.out.write("Batch is not a JSON array")
+        self.response.set_status(400)
+        return
+      bodies = [simplejson.dumps(body) for body in bodies]
+    else:
+      bodies = [line for line in self.request.body.splitlines() if line.strip()]
+      if contenttype == CT_NDJSON:
+        contenttype = CT_JSON
+    if len(bodies) > PUBLISH_BATCH_MAX:
+      self.response.out.write("Batch of %d messages exceeds the maximum of %d" % (len(bodies), PUBLISH_BATCH_MAX))
+      self.response.set_status(400)
+      return
+
+    bucket = messagebucket(datetime.datetime.now())
+    messages = [Message(
+      contenttype = contenttype,
+      body = body,
+      channel = channel,
+      compact = channel.compact,
+      bucket = bucket,
+    ) for body in bodies]
+    db.put(messages)
+    enqueuesequencer(channel.key())
+    addtasks([taskqueue.Task(url='/fanout/%s' % (message.key(), )) for message in messages])
+    logging.debug("Batch of %d messages published to channel %s" % (len(messages), channel.key().id()))
+
+    writejson(self.response, {
+      'messages': [{
+        'resource': "%smessage/%s" % (self.request.path_url, str(message.key())),
+        'key': str(message.key()),
+      } for message in messages],
+    })
+    self.response.set_status(202)
+
   def delete(self, channelid):
     """Handle deletion of a channel. Only allow if there are no subscribers"""
     channel = self._getentity(Channel, channelid)
@@ -217,69 +1321,83 @@ class ChannelHandler(EntityRequestHandler):
       self.response.headers['Allow'] = "GET, POST"
     else:
       channel.delete()
+      uncacheentity(channel)
       self.response.set_status(204)
 
 
-class ChannelSubscriberSubmissionformHandler(webapp.RequestHandler):
+class ChannelSubscriberSubmissionformHandler(EntityRequestHandler):
   """Handles the subscriber submission form for a given channel,
   i.e. resource /channel/{id}/subscriber/submissionform
   """
   def get(self, channelid):
     """Handles a GET to the /channel/{id}/subscriber/submissionform resource
     """
-    channel = Channel.get_by_id(int(channelid))
-    if channel is None:
-      self.response.out.write("Channel %s not found" % (channelid, ))
-      self.response.set_status(404)
-      return
+    channel = self._getentity(Channel, channelid)
+    if channel is None: return
 
     template_values = {
       'channel': channel,
       'channelsubscriberresource': '/channel/' + channelid + '/subscriber/',
     }
-    path = os.path.join(os.path.dirname(__file__), 'subscribersubmissionform.html')
-    self.response.out.write(template.render(path, template_values))
+    self.response.out.write(rendertemplate('subscribersubmissionform.html', template_values))
 
 
-class ChannelSubscriberContainerHandler(webapp.RequestHandler):
+class ChannelSubscriberContainerHandler(EntityRequestHandler):
   """Handles the subscribers for a given channel, i.e. resource
   /channel/{id}/subscriber/
   """
   def get(self, channelid):
     """Handles a GET to the /channel/{id}/subscriber/ resource
     """
-    channel = Channel.get_by_id(int(channelid))
-    if channel is None:
-      self.response.out.write("Channel %s not found" % (channelid, ))
-      self.response.set_status(404)
-      return
+    channel = self._getentity(Channel, channelid)
+    if channel is None: return
+
+    page = self._fetchpage(Subscriber.all().filter('channel =', channel).order('-created'))
+    if page is None: return
+    results, paging = page
 
     subscribers = []
-    for subscriber in Subscriber.all().filter('channel =', channel):
+    for subscriber in results:
       subscribers.append({
         'subscriberid': subscriber.key().id(),
         'name': subscriber.name,
         'resource': subscriber.resource,
+        'mode': subscriber.mode,
+        'batchsize': subscriber.batchsize,
+        'batchwait': subscriber.batchwait,
         'created': subscriber.created,
       })
 
+    if acceptsjson(self.request):
+      info = {
+        'subscribers': [{
+          'subscriber': "%s%d/" % (self.request.path_url, s['subscriberid']),
+          'name': s['name'],
+          'resource': s['resource'],
+          'mode': s['mode'],
+          'batchsize': s['batchsize'],
+          'batchwait': s['batchwait'],
+          'created': isoformat(s['created']),
+        } for s in subscribers],
+        'paging': paging,
+      }
+      writejson(self.response, info)
+      return
+
     template_values = {
       'channel': channel,
       'subscribers': subscribers,
+      'paging': paging,
     }
-    path = os.path.join(os.path.dirname(__file__), 'channelsubscriber.html')
-    self.response.out.write(template.render(path, template_values))
+    self.response.out.write(rendertemplate('channelsubscriber.html', template_values))
 
   def post(self, channelid):
     """Handles a POST to the /channel/{id}/subscriber/ resource
     which is to add a subscriber to the channel
     """
 #   Get channel first
-    channel = Channel.get_by_id(int(channelid))
-    if channel is None:
-      self.response.out.write("Channel %s not found" % (channelid, ))
-      self.response.set_status(404)
-      return
+    channel = self._getentity(Channel, channelid)
+    if channel is None: return
 
 #   Add subscriber
     name = self.request.get('name').rstrip('\n')
@@ -288,11 +1406,19 @@ class ChannelSubscriberContainerHandler(webapp.RequestHandler):
     subscriber.channel = channel
     subscriber.name = name
     subscriber.resource = resource
+    if self.request.get('mode') == MODE_PULL:
+      subscriber.mode = MODE_PULL
+    if isNumber(self.request.get('batchsize')):
+      subscriber.batchsize = max(0, min(int(self.request.get('batchsize')), SUBSCRIBER_BATCH_MAX))
+    if isNumber(self.request.get('batchwait')):
+      subscriber.batchwait = max(0, int(self.request.get('batchwait')))
     subscriber.put()
 #   Not sure I like this ... re-put()ing
     if len(subscriber.name) == 0:
       subscriber.name = 'subscriber-' + str(subscriber.key().id())
       subscriber.put()
+    uncacheentity(subscriber)
+    uncachesubscribers(channel.key())
 
 #   If we've got here from a web form, redirect the user to the 
 #   channel subscriber resource, otherwise return the 201
@@ -319,12 +1445,13 @@ class ChannelSubscriberHandler(EntityRequestHandler):
       'channel': channel,
       'subscriber': subscriber,
     }
-    path = os.path.join(os.path.dirname(__file__), 'subscriber_detail.html')
-    self.response.out.write(template.render(path, template_values))
+    self.response.out.write(rendertemplate('subscriber_detail.html', template_values))
 
   def delete(self, channelid, subscriberid):
     """Handle deletion of a subscribers.
-    Only allow if there are no outstanding deliveries."""
+    Only allow if there are no outstanding deliveries, including those
+    awaiting batch delivery or to be pulled (dead-lettered deliveries are
+    not outstanding, and are deleted along with the subscriber)."""
 
     channel = self._getentity(Channel, channelid)
     if channel is None: return
@@ -332,29 +1459,217 @@ class ChannelSubscriberHandler(EntityRequestHandler):
     subscriber = self._getentity(Subscriber, subscriberid)
     if subscriber is None: return
 
-    nrdeliveries = Delivery.all().filter('recipient =', subscriber).filter('status !=', STATUS_DELIVERED).count()
+    channelkey = Subscriber.channel.get_value_for_datastore(subscriber)
+    if channelkey != channel.key():
+      self.response.out.write("Subscriber %s is not subscribed to channel %s" % (subscriberid, channelid))
+      self.response.set_status(404)
+      return
+
+    nrdeliveries = 0
+    for status in (None, STATUS_BATCHED, STATUS_PULL):
+      nrdeliveries += Delivery.all().filter('recipient =', subscriber).filter('status =', status).count()
     if nrdeliveries:
       # Can't delete if deliveries still outstanding
       self.response.set_status(405, "CANNOT DELETE - %s DELIVERIES OUTSTANDING" % nrdeliveries)
       self.response.headers['Allow'] = "GET"
     else:
       subscriber.delete()
+      uncacheentity(subscriber)
+      uncachesubscribers(channelkey)
+
+      # Its dead letters go with it, as there is no one left to re-drive
+      # them to
+      query = Delivery.all(keys_only=True).filter('recipient =', subscriber).filter('status =', STATUS_DEADLETTER)
+      while True:
+        deliverykeys = query.fetch(DELIVERY_BATCH_SIZE)
+        db.delete(deliverykeys)
+        if len(deliverykeys) < DELIVERY_BATCH_SIZE:
+          break
       self.response.set_status(204)
 
 
-class SubscriberContainerHandler(webapp.RequestHandler):
+class SubscriberMessagesHandler(EntityRequestHandler):
+  """Handles the pending messages of a pull subscriber, i.e. resource
+  /channel/{id}/subscriber/{id}/messages
+  GET returns a batch of the messages waiting to be pulled, oldest first,
+  as JSON, with a cursor for the next batch. POST acknowledges messages,
+  given as a JSON list of message keys in "ack" (or as ack parameters),
+  marking their deliveries delivered.
+  """
+  def _pullsubscriber(self, channelid, subscriberid):
+    channel = self._getentity(Channel, channelid)
+    if channel is None: return
+
+    subscriber = self._getentity(Subscriber, subscriberid)
+    if subscriber is None: return
+
+    if subscriber.mode != MODE_PULL:
+      self.response.out.write("Subscriber %s is not a pull subscriber" % (subscriberid, ))
+      self.response.set_status(404)
+      return
+    return subscriber
+
+  def get(self, channelid, subscriberid):
+    subscriber = self._pullsubscriber(channelid, subscriberid)
+    if subscriber is None: return
+
+    limit = PAGE_SIZE
+    if isNumber(self.request.get('limit')):
+      limit = max(1, min(int(self.request.get('limit')), PULL_BATCH_MAX))
+    query = Delivery.all().filter('recipient =', subscriber).filter('status =', STATUS_PULL).order('created')
+    cursor = self.request.get('cursor')
+    try:
+      if cursor:
+        query.with_cursor(cursor)
+      deliveries = query.fetch(limit)
+    except (db.BadValueError, db.BadRequestError):
+      self.response.out.write("Invalid cursor %s" % (cursor, ))
+      self.response.set_status(400)
+      return
+
+    messages = prefetchrefs(deliveries, Delivery.message)
+    writejson(self.response, {
+      'messages': [batchitem(messages[key]) for key in
+                   [Delivery.message.get_value_for_datastore(d) for d in deliveries]
+                   if key in messages],
+      'cursor': query.cursor(),
+      'more': len(deliveries) == limit,
+    })
+
+  def post(self, channelid, subscriberid):
+    from django.utils import simplejson
+    subscriber = self._pullsubscriber(channelid, subscriberid)
+    if subscriber is None: return
+
+    if self.request.headers.get('Content-Type', '').startswith(CT_JSON):
+      try:
+        ack = simplejson.loads(self.request.body)['ack']
+      except (ValueError, KeyError, TypeError):
+        ack = None
+    else:
+      ack = self.request.get_all('ack')
+    if not isinstance(ack, list):
+      self.response.out.write("No list of messages to acknowledge")
+      self.response.set_status(400)
+      return
+    try:
+      messagekeys = [db.Key(key) for key in ack]
+    except db.BadKeyError:
+      self.response.out.write("Invalid message key in %s" % (ack, ))
+      self.response.set_status(400)
+      return
+
+    # Deliveries are keyed by message and subscriber, so are fetched
+    # with a single batch get
+    names = [Delivery.deliveryname(key, subscriber.key()) for key in messagekeys]
+    deliveries = [d for d in Delivery.get_by_key_name(names)
+                  if d is not None and d.status == STATUS_PULL]
+    delivered = {}
+    for delivery in deliveries:
+      delivery.status = STATUS_DELIVERED
+      delivery.attempts = (delivery.attempts or 0) + 1
+      if delivery.replayed:
+        continue
+      shardkey = (Delivery.message.get_value_for_datastore(delivery), delivery.shard)
+      delivered[shardkey] = delivered.get(shardkey, 0) + 1
+    db.put(deliveries)
+    for (messagekey, shard), count in delivered.items():
+      countdelivered(messagekey, shard, count)
+
+    writejson(self.response, {'acknowledged': len(deliveries)})
+
+
+class SubscriberReplayHandler(EntityRequestHandler):
+  """Handles replays to a subscriber, i.e. resource
+  /channel/{id}/subscriber/{id}/replay
+  POST replays the channel's messages to the subscriber, either those
+  after the sequence number given as since, or those created from the
+  time given as from, up to the last one published so far. The replay
+  is carried out in the background, and a 202 returned straight away.
+  """
+  def post(self, channelid, subscriberid):
+    channel = self._getentity(Channel, channelid)
+    if channel is None: return
+
+    subscriber = self._getentity(Subscriber, subscriberid)
+    if subscriber is None: return
+
+    if Subscriber.channel.get_value_for_datastore(subscriber) != channel.key():
+      self.response.out.write("Subscriber %s is not subscribed to channel %s" % (subscriberid, channelid))
+      self.response.set_status(404)
+      return
+
+    since = self.request.get('since')
+    start = self.request.get('from')
+    if since:
+      if not since.isdigit():
+        self.response.out.write("Invalid sequence number %s" % (since, ))
+        self.response.set_status(400)
+        return
+      after = int(since)
+    elif start:
+      try:
+        start = datetime.datetime.strptime(start, "%Y-%m-%dT%H:%M:%SZ")
+      except ValueError:
+        self.response.out.write("Invalid time %s" % (start, ))
+        self.response.set_status(400)
+        return
+      # Start from the first message from then that has been numbered
+      # (those still being numbered are newer than any that have been)
+      after = lastseq(channel.key())
+      for message in (Message.all().filter('channel =', channel)
+          .filter('created >=', start).order('created').fetch(REPLAY_BATCH_SIZE)):
+        if message.seq is not None:
+          after = message.seq - 1
+          break
+    else:
+      self.response.out.write("Replay needs a since sequence number or a from time")
+      self.response.set_status(400)
+      return
+
+    upto = lastseq(channel.key())
+    if after < upto:
+      enqueuereplay(subscriberid, "%d" % (time.time() * 1000), 0, after, upto)
+      logging.info("Replay of messages %d to %d to subscriber %s queued" % (after + 1, upto, subscriberid))
+
+    writejson(self.response, {
+      'since': after,
+      'upto': upto,
+      'messages': max(0, upto - after),
+    })
+    self.response.set_status(202)
+
+
+class SubscriberContainerHandler(EntityRequestHandler):
   """Handles the subscriber container resource, i.e.
   /subscriber/
   GET will just return a list of subscribers, by channel
   """
   def get(self):
-    subscribers = db.GqlQuery("SELECT * FROM Subscriber "
-                                  "ORDER BY channel ASC, created DESC")
+    page = self._fetchpage(Subscriber.all().order('channel').order('-created'))
+    if page is None: return
+    subscribers, paging = page
+
+    if acceptsjson(self.request):
+      info = {
+        'subscribers': [{
+          'subscriber': "%s/channel/%d/subscriber/%d/" % (self.request.host_url,
+            Subscriber.channel.get_value_for_datastore(s).id(), s.key().id()),
+          'name': s.name,
+          'resource': s.resource,
+          'created': isoformat(s.created),
+        } for s in subscribers],
+        'paging': paging,
+      }
+      writejson(self.response, info)
+      return
+
+    prefetchrefs(subscribers, Subscriber.channel)
     template_values = {
       'subscribers': subscribers,
+      'paging': paging,
     }
-    path = os.path.join(os.path.dirname(__file__), 'subscriber.html')
-    self.response.out.write(template.render(path, template_values))
+    self.response.out.write(rendertemplate('subscriber.html', template_values))
     
 
 class ChannelMessageHandler(webapp.RequestHandler):
@@ -368,57 +1683,156 @@ class ChannelMessageHandler(webapp.RequestHandler):
       self.response.set_status(404)
       return
 
-    deliveries = Delivery.all().filter('message =', message)
+    deliveries = deliveryreport(message)
 
-    channelurl = "%s://%s/channel/%d/" % (self.request.scheme, self.request.host, message.channel.key().id())
+    channelurl = "%s://%s/channel/%d/" % (self.request.scheme, self.request.host,
+      Message.channel.get_value_for_datastore(message).id())
 
-    # Poor conneg
-    if (self.request.headers.has_key('Accept')
-      and self.request.headers['Accept'] == CT_JSON):
+    if acceptsjson(self.request):
       logging.info("JSON requested")
       deliveryinfo = []
       for d in deliveries:
         deliveryinfo.append({
-          'recipient': "%ssubscriber/%d/" % (channelurl, d.recipient.key().id()),
-          'status': d.status,
-          'timestamp': d.updated.strftime("%Y-%m-%dT%H:%M:%SZ"),
+          'recipient': "%ssubscriber/%d/" % (channelurl, d['recipientkey'].id()),
+          'status': d['status'],
+          'timestamp': isoformat(d['updated']),
       })
       info = {
         'message': {
           'resource': "%smessage/%s" % (channelurl, str(message.key())),
           'key': str(message.key()),
-          'created': message.created.strftime("%Y-%m-%dT%H:%M:%SZ"),
+          'seq': message.seq,
+          'created': isoformat(message.created),
           'channel': channelurl,
           'delivery': deliveryinfo,
         },
       }
-      self.response.out.write(simplejson.dumps(info))
-      self.response.headers['Content-Type'] = CT_JSON
+      writejson(self.response, info)
       return
 
+    recipients = db.get([d['recipientkey'] for d in deliveries])
+    for delivery, recipient in zip(deliveries, recipients):
+      delivery['recipient'] = recipient
+
     template_values = {
       'message': message,
-      #'deliveries': Delivery.all().filter('message =', message),
       'deliveries': deliveries,
     }
-    path = os.path.join(os.path.dirname(__file__), 'messagedetail.html')
-    self.response.out.write(template.render(path, template_values))
+    self.response.out.write(rendertemplate('messagedetail.html', template_values))
 
 
 class ChannelMessageContainerHandler(EntityRequestHandler):
   """Handles the message container resource for a channel, in the form of
   /channel/{cid}/message/
+  Lists the channel's messages, most recent first or, given a since
+  parameter, those after that sequence number, in order.
   """
   def get(self, channelid):
     channel = self._getentity(Channel, channelid)
     if channel is None: return
 
+    query = Message.all().filter('channel =', channel)
+    since = self.request.get('since')
+    if since:
+      if not since.isdigit():
+        self.response.out.write("Invalid sequence number %s" % (since, ))
+        self.response.set_status(400)
+        return
+      query.filter('seq >', int(since)).filter('seq <=', lastseq(channel.key())).order('seq')
+    else:
+      query.order('-seq')
+    page = self._fetchpage(query)
+    if page is None: return
+    messages, paging = page
+
+    if acceptsjson(self.request):
+      info = {
+        'messages': [{
+          'resource': "%s%s" % (self.request.path_url, str(m.key())),
+          'key': str(m.key()),
+          'seq': m.seq,
+          'created': isoformat(m.created),
+        } for m in messages],
+        'paging': paging,
+      }
+      writejson(self.response, info)
+      return
+
+    prefetchrefs(messages, Message.channel)
     template_values = {
       'channel': channel,
-      'messages': Message.all().filter('channel =', channel),
+      'messages': messages,
+      'paging': paging,
     }
-    path = os.path.join(os.path.dirname(__file__), 'messagelist.html')
-    self.response.out.write(template.render(path, template_values))
+    self.response.out.write(rendertemplate('messagelist.html', template_values))
+
+
+class ChannelStreamHandler(EntityRequestHandler):
+  """Handles the stream of messages published to a channel, i.e. resource
+  /channel/{id}/stream
+  GET waits for messages published after the one whose sequence number
+  is given as the event id (in a Last-Event-ID header or a since
+  parameter) or, without one, after the request arrived, and returns
+  them as soon as there are any. With Accept: text/event-stream they
+  come as Server-Sent Events, so that an EventSource picks up where it
+  left off each time it reconnects; otherwise as JSON, with the event id
+  to long-poll with next.
+  """
+  def get(self, channelid):
+    channel = self._getentity(Channel, channelid)
+    if channel is None: return
+
+    lastid = (self.request.headers.get('Last-Event-ID') or self.request.get('since')).strip()
+    if lastid:
+      if not lastid.isdigit():
+        self.response.out.write("Invalid event id %s" % (lastid, ))
+        self.response.set_status(400)
+        return
+      since = int(lastid)
+    else:
+      since = lastseq(channel.key())
+    timeout = STREAM_TIMEOUT
+    if isNumber(self.request.get('timeout')):
+      timeout = max(0, min(int(self.request.get('timeout')), STREAM_TIMEOUT))
+
+    messages = self._waitformessages(channel.key(), since, timeout)
+
+    if CT_EVENTSTREAM in self.request.headers.get('Accept', ''):
+      from django.utils import simplejson
+      self.response.headers['Content-Type'] = CT_EVENTSTREAM
+      self.response.headers['Cache-Control'] = 'no-cache'
+      self.response.out.write("retry: %d\n\n" % (STREAM_RETRY, ))
+      for message in messages:
+        self.response.out.write("id: %d\nevent: message\ndata: %s\n\n"
+          % (message.seq, simplejson.dumps(batchitem(message))))
+      if not messages:
+        self.response.out.write(": no new messages\n\n")
+      return
+
+    if messages:
+      since = messages[-1].seq
+    writejson(self.response, {
+      'messages': [batchitem(message) for message in messages],
+      'lastid': since,
+    })
+
+  def _waitformessages(self, channelkey, since, timeout):
+    """Returns the messages published to the channel after sequence
+    number since, in order, waiting up to timeout seconds for there to be
+    any. The datastore is only queried again once the channel's publish
+    marker has changed.
+    """
+    deadline = time.time() + timeout
+    query = lambda: (Message.all().filter('channel =', channelkey).filter('seq >', since)
+      .filter('seq <=', lastseq(channelkey)).order('seq').fetch(STREAM_BATCH_MAX))
+    marker = publishmarker(channelkey)
+    messages = query()
+    while not messages and time.time() < deadline:
+      current = waitforpublish(channelkey, marker, deadline - time.time())
+      if current != marker:
+        marker = current
+        messages = query()
+    return messages
 
 
 class ChannelMessageSubmissionformHandler(EntityRequestHandler):
@@ -432,11 +1846,10 @@ class ChannelMessageSubmissionformHandler(EntityRequestHandler):
     template_values = {
       'channel': channel,
     }
-    path = os.path.join(os.path.dirname(__file__), 'messagesubmissionform.html')
-    self.response.out.write(template.render(path, template_values))
+    self.response.out.write(rendertemplate('messagesubmissionform.html', template_values))
 
 
-class MessageHandler(webapp.RequestHandler):
+class MessageHandler(EntityRequestHandler):
   """Handles the message overview resource, i.e.
   /message/
   GET will just return a list of messages, by channel
@@ -444,30 +1857,245 @@ class MessageHandler(webapp.RequestHandler):
   you can POST to this resource (which you can't, of course).
   """
   def get(self):
-    # This seems expensive. TODO: refactor
-    messages = []
-    for message in db.GqlQuery("SELECT * FROM Message ORDER BY created DESC"):
-      recipients = Delivery.all().filter('message =', message).count()
-      delivered = Delivery.all().filter('message =', message).filter('status =', STATUS_DELIVERED).count()
-      messages.append({
-        'message': message,
-        'recipients': recipients,
-        'delivered': delivered,
-      })
+    page = self._fetchpage(Message.all().order('-created'))
+    if page is None: return
+    results, paging = page
+
+    messages = [{
+      'message': message,
+      'recipients': message.recipients,
+      'delivered': delivered,
+    } for message, delivered in zip(results, deliverycounts(results))]
+
+    if acceptsjson(self.request):
+      info = {
+        'messages': [{
+          'resource': "%s/channel/%d/message/%s" % (self.request.host_url,
+            Message.channel.get_value_for_datastore(m['message']).id(), str(m['message'].key())),
+          'key': str(m['message'].key()),
+          'created': isoformat(m['message'].created),
+          'recipients': m['recipients'],
+          'delivered': m['delivered'],
+        } for m in messages],
+        'paging': paging,
+      }
+      writejson(self.response, info)
+      return
+
+    prefetchrefs(results, Message.channel)
     template_values = {
       'messages': messages,
+      'paging': paging,
     }
-    path = os.path.join(os.path.dirname(__file__), 'message.html')
-    self.response.out.write(template.render(path, template_values))
+    self.response.out.write(rendertemplate('message.html', template_values))
     
 
 
-class DistributorWorker(webapp.RequestHandler):
-  """Task Queue worker - distributes a given message. The task queue 
-  mechanism may retry this if not all the deliveries have been made.
-  It should keep retrying until they all have been made.
+class DeadLetterHandler(webapp.RequestHandler):
+  """Handles the dead letter resource, i.e.
+  /deadletter/
+  GET returns the most recently dead-lettered deliveries, POST re-drives
+  dead-lettered deliveries, optionally just those for a given message
+  or subscriber
+  """
+  def _deadletters(self):
+    """Query for dead-lettered deliveries, restricted to the message
+    and/or subscriber given in the request. Returns None, having set
+    a 400, if the message key is not valid.
+    """
+    query = Delivery.all().filter('status =', STATUS_DEADLETTER)
+    if self.request.get('message'):
+      try:
+        query.filter('message =', db.Key(self.request.get('message')))
+      except db.BadKeyError:
+        self.response.out.write("Invalid message key %s" % (self.request.get('message'), ))
+        self.response.set_status(400)
+        return
+    if isNumber(self.request.get('subscriber')):
+      query.filter('recipient =', db.Key.from_path('Subscriber', int(self.request.get('subscriber'))))
+    return query
+
+  def get(self):
+    query = self._deadletters()
+    if query is None: return
+    deliveries = query.order('-updated').fetch(DEADLETTER_BATCH_SIZE)
+    referenced = prefetchrefs(deliveries, Delivery.message, Delivery.recipient)
+    prefetchrefs([e for e in referenced.values() if isinstance(e, Message)], Message.channel)
+
+    if acceptsjson(self.request):
+      baseurl = "%s://%s" % (self.request.scheme, self.request.host)
+      deadletters = []
+      for d in deliveries:
+        channelurl = "%s/channel/%d/" % (baseurl, Message.channel.get_value_for_datastore(d.message).id())
+        deadletters.append({
+          'message': "%smessage/%s" % (channelurl, str(Delivery.message.get_value_for_datastore(d))),
+          'recipient': "%ssubscriber/%d/" % (channelurl, Delivery.recipient.get_value_for_datastore(d).id()),
+          'attempts': d.attempts,
+          'timestamp': isoformat(d.updated),
+        })
+      writejson(self.response, {'deadletters': deadletters})
+      return
+
+    # Dead letters left behind by a deleted subscriber are listed without
+    # one, rather than dereferenced
+    template_values = {
+      'deadletters': [{
+        'delivery': d,
+        'recipientkey': Delivery.recipient.get_value_for_datastore(d),
+        'recipient': referenced.get(Delivery.recipient.get_value_for_datastore(d)),
+      } for d in deliveries],
+    }
+    self.response.out.write(rendertemplate('deadletter.html', template_values))
+
+  def post(self):
+    """Re-drives a batch of dead-lettered deliveries: each is reset
+    to be attempted afresh, and distribution is kicked off again for
+    the message shards they belong to. Those whose subscriber has since
+    been deleted are skipped, as there's nowhere to deliver them.
+    """
+    query = self._deadletters()
+    if query is None: return
+    now = datetime.datetime.now()
+    deliveries = query.fetch(DEADLETTER_BATCH_SIZE)
+    referenced = prefetchrefs(deliveries, Delivery.recipient)
+    deliveries = [d for d in deliveries if Delivery.recipient.get_value_for_datastore(d) in referenced]
+    shards = {}
+    for delivery in deliveries:
+      delivery.status = None
+      delivery.attempts = 0
+      delivery.nextattempt = now
+      # Restart the age limit too, or an old delivery would go
+      # straight back to being dead-lettered on its first failure
+      delivery.created = now
+      messagekey = Delivery.message.get_value_for_datastore(delivery)
+      shards[(str(messagekey), delivery.shard)] = True
+    db.put(deliveries)
+
+    # Distribution tasks are named as the distributor names its own
+    # re-queues, so they join any chain already due now rather than
+    # starting another alongside it
+    for messagekey, shard in shards.keys():
+      enqueuedistributor(messagekey, shard)
+
+    logging.info("Re-drove %d dead-lettered deliveries" % (len(deliveries), ))
+    if self.request.get('deadletterform'):
+      self.redirect('/deadletter/')
+    else:
+      self.response.out.write("%d deliveries re-driven\n" % (len(deliveries), ))
+
+
+class FanoutWorker(webapp.RequestHandler):
+  """Task Queue worker - fans out a message that was published
+  asynchronously. If the task is retried, the deliveries already
+  created are overwritten rather than duplicated.
   """
   def post(self, messageid):
+    message = Message.get(messageid)
+    if message is None:
+      logging.debug("Message %s does not exist, returning 200" % (messageid, ))
+      return
+    if message.shards:
+      logging.debug("Message %s has already been fanned out" % (messageid, ))
+      return
+    fanout(message)
+
+
+class DistributorWorker(webapp.RequestHandler):
+  """Task Queue worker - distributes a given message, or just one shard
+  of its deliveries if a shard is given. Each failed delivery is
+  rescheduled with its own backoff, and this worker re-queues itself
+  for when the next of them falls due, so a retry pass only touches
+  the deliveries that are actually due. Re-queues are named by due
+  time, and a lease keeps to one worker per shard at a time.
+  """
+  def _undelivered(self, message, shard):
+    """Query for the deliveries of the message (shard) that have not
+    yet been delivered (status will be None)
+    """
+    query = Delivery.all().filter('message =', message).filter('status =', None)
+    if shard is not None:
+      query.filter('shard =', int(shard))
+    return query
+
+  def _resolve(self, subscribers, keys):
+    """Adds the details of any of the subscriber keys missing from
+    subscribers (subscribed since the list was cached, or since deleted)
+    """
+    missing = [key for key in keys if key not in subscribers]
+    if missing:
+      for key, subscriber in zip(missing, db.get(missing)):
+        if subscriber is None:
+          subscribers[key] = (key, None, 0, 0, MODE_PUSH)
+        else:
+          subscribers[key] = (key, subscriber.resource, subscriber.batchsize or 0,
+                              subscriber.batchwait or 0, subscriber.mode or MODE_PUSH)
+
+  def _handover(self, deliveries, subscribers):
+    """Hands over deliveries to subscribers that take their messages in
+    batches to batch delivery, once the deliveries have been stored
+    """
+    counts = {}
+    for delivery in deliveries:
+      key = Delivery.recipient.get_value_for_datastore(delivery)
+      counts[key] = counts.get(key, 0) + 1
+    for key, count in counts.items():
+      key, resource, batchsize, batchwait, mode = subscribers[key]
+      enqueuebatchdelivery(key, batchwait, count >= batchsize)
+
+  def _distributeshard(self, message, shard, subscribers, headers, now):
+    """Makes the first attempt at each delivery in a compact message's
+    shard that hasn't had one, marking it in the shard's bitmaps. Only
+    the recipients that fail, take their messages in batches, or pull
+    them, get a Delivery, to carry on from there.
+    """
+    deliveryshard = DeliveryShard.get_by_key_name(DeliveryShard.shardname(message.key(), shard))
+    if deliveryshard is None:
+      return
+    recipients = deliveryshard.recipientkeys()
+    pending = [index for index in range(len(recipients))
+               if not (deliveryshard.isdelivered(index) or deliveryshard.isfailed(index))]
+    for start in range(0, len(pending), DELIVERY_BATCH_SIZE):
+      indexes = pending[start:start + DELIVERY_BATCH_SIZE]
+      self._resolve(subscribers, [recipients[index] for index in indexes])
+
+      pulled = []
+      batched = []
+      direct = []
+      for index in indexes:
+        key = recipients[index]
+        if subscribers[key][4] == MODE_PULL:
+          deliveryshard.markfailed(index)
+          pulled.append(Delivery(key_name=Delivery.deliveryname(message.key(), key),
+                                 message=message, recipient=key, shard=shard,
+                                 status=STATUS_PULL, nextattempt=now))
+        elif subscribers[key][2]:
+          deliveryshard.markfailed(index)
+          batched.append(Delivery(key_name=Delivery.deliveryname(message.key(), key),
+                                  message=message, recipient=key, shard=shard,
+                                  status=STATUS_BATCHED, nextattempt=now))
+        else:
+          direct.append(index)
+      statuses = postconcurrently([(subscribers[recipients[index]][1], message.body, headers)
+                                   for index in direct])
+
+      delivered = 0
+      failures = []
+      for index, status in zip(direct, statuses):
+        if status is not None and status < 400:
+          deliveryshard.markdelivered(index)
+          delivered += 1
+        else:
+          deliveryshard.markfailed(index)
+          failure = Delivery(key_name=Delivery.deliveryname(message.key(), recipients[index]),
+                             message=message, recipient=recipients[index], shard=shard)
+          recordattempt(failure, status, now, retrydelay(subscribers[recipients[index]][1]))
+          failures.append(failure)
+      db.put([deliveryshard] + failures + batched + pulled)
+      self._handover(batched, subscribers)
+      if delivered:
+        countdelivered(message.key(), shard, delivered)
+
+  def post(self, messageid, shard=None):
     # Retrieve the message, make sure it exists
     message = Message.get(messageid)
     if message is None:
@@ -475,60 +2103,389 @@ class DistributorWorker(webapp.RequestHandler):
        self.response.set_status(200)
        return
 
-    # Assume all deliveries are successful (i.e. this task is done)
-    deliveriessucceeded = True
+    # Only one worker distributes a shard at a time
+    lease = 'dist-%s' % (messageid, )
+    if shard is not None:
+      lease += '-%d' % (int(shard), )
+    if not acquirelease(lease):
+      logging.debug("Distribution of %s already under way, retrying" % (self.request.path, ))
+      enqueuedistributor(message.key(), shard, time.time() + WORKER_LEASE_RETRY)
+      return
+    try:
+      self._distribute(message, shard)
+    finally:
+      releaselease(lease)
+
+  def _distribute(self, message, shard):
+
+    # Subscriber details come from the channel's cached subscriber list,
+    # rather than from dereferencing each delivery's recipient
+    subscribers = {}
+    for subscriber in subscriberlist(Message.channel.get_value_for_datastore(message)):
+      subscribers[subscriber[0]] = subscriber
+
+    now = datetime.datetime.now()
+    headers = { 'Content-Type': message.contenttype }
+
+    # Messages on compact channels have their first attempts tracked
+    # in the shard's bitmaps, and only failures as Delivery entities
+    if message.compact:
+      self._distributeshard(message, int(shard or 0), subscribers, headers, now)
+
+    # Process those undelivered deliveries that are due, a batch at a time
+    due = self._undelivered(message, shard).filter('nextattempt <=', now)
+    while True:
+      deliveries = due.fetch(DELIVERY_BATCH_SIZE)
+      if not deliveries:
+        break
+
+      # Deliveries to pull subscribers are left for them to fetch, and
+      # those to subscribers that take their messages in batches are
+      # handed over to batch delivery. The rest are made with a POST
+      # to each recipient's resource sending the published body, with the
+      # published body's content-type. These are made concurrently so a
+      # slow subscriber only holds up its own delivery
+      recipients = [Delivery.recipient.get_value_for_datastore(d) for d in deliveries]
+      self._resolve(subscribers, recipients)
+      batched = []
+      direct = []
+      for delivery, key in zip(deliveries, recipients):
+        if subscribers[key][4] == MODE_PULL:
+          delivery.status = STATUS_PULL
+        elif subscribers[key][2]:
+          delivery.status = STATUS_BATCHED
+          batched.append(delivery)
+        else:
+          direct.append((delivery, key))
+      statuses = postconcurrently([(subscribers[key][1], message.body, headers) for delivery, key in direct])
+
+      # If we've had a successful status then consider that
+      # particular delivery done. Otherwise, count the attempt and
+      # schedule the next one.
+      delivered = 0
+      for (delivery, key), status in zip(direct, statuses):
+        logging.debug("Delivery %s returned status %s" % (delivery.key(), status))
+        if recordattempt(delivery, status, now, retrydelay(subscribers[key][1])) and not delivery.replayed:
+          delivered += 1
+      db.put(deliveries)
+      self._handover(batched, subscribers)
+      if delivered:
+        countdelivered(message.key(), int(shard or 0), delivered)
+
+      if len(deliveries) < DELIVERY_BATCH_SIZE:
+        break
+      due.with_cursor(due.cursor())
+
+    # If there are deliveries still to be made, come back
+    # when the earliest of them is due
+    nextdue = self._undelivered(message, shard).order('nextattempt').get()
+    if nextdue is not None and nextdue.nextattempt is None:
+      logging.warning("Delivery %s has no next attempt time, not rescheduling" % (nextdue.key(), ))
+    elif nextdue is not None:
+      countdown = max(0, timedelta_seconds(nextdue.nextattempt - datetime.datetime.now()))
+      enqueuedistributor(message.key(), shard, time.time() + countdown + 1)
+      logging.debug("Distribution of %s rescheduled in %d seconds" % (self.request.path, countdown))
+
+
+class BatchDeliveryWorker(webapp.RequestHandler):
+  """Task Queue worker - delivers the messages handed over to batch
+  delivery for a subscriber, with a POST of a JSON array of up to the
+  subscriber's batch size of them at a time. A failed batch has each of
+  its deliveries rescheduled with backoff as usual, and this worker
+  re-queues itself for when the next of them falls due. Only one worker
+  delivers to a subscriber at a time.
+  """
+  def _batched(self, subscriber):
+    return Delivery.all().filter('recipient =', subscriber).filter('status =', STATUS_BATCHED)
+
+  def post(self, subscriberid):
+    subscriber = Subscriber.get_by_id(int(subscriberid))
+    if subscriber is None:
+      logging.debug("Subscriber %s does not exist, returning 200" % (subscriberid, ))
+      return
 
-    # For this message, process those deliveries that have not yet been
-    # delivered (status will be None)
-    for delivery in Delivery.all().filter('message =', message).filter('status =', None):
-      logging.debug("Processing delivery %s" % (delivery.key(), ))
+    lease = 'batch-%s' % (subscriberid, )
+    if not acquirelease(lease):
+      logging.debug("Batch delivery to subscriber %s already under way, retrying" % (subscriberid, ))
+      enqueuedue(self.request.path, lease, time.time() + WORKER_LEASE_RETRY)
+      return
+    try:
+      self._deliver(subscriber, subscriberid)
+    finally:
+      releaselease(lease)
+
+  def _deliver(self, subscriber, subscriberid):
+    from django.utils import simplejson
+    batchsize = max(1, min(subscriber.batchsize or 1, SUBSCRIBER_BATCH_MAX))
+
+    now = datetime.datetime.now()
+    while True:
+      deliveries = self._batched(subscriber).filter('nextattempt <=', now).order('nextattempt').fetch(batchsize)
+      if not deliveries:
+        break
+
+      messagekeys = [Delivery.message.get_value_for_datastore(d) for d in deliveries]
+      messages = [message for message in db.get(messagekeys) if message is not None]
+      payload = simplejson.dumps([batchitem(message) for message in messages])
+      status = postconcurrently([(subscriber.resource, payload, { 'Content-Type': CT_JSON })])[0]
+      logging.debug("Batch of %d deliveries to subscriber %s returned status %s" % (len(deliveries), subscriberid, status))
+
+      delay = retrydelay(subscriber.resource)
+      delivered = {}
+      for delivery, messagekey in zip(deliveries, messagekeys):
+        if recordattempt(delivery, status, now, delay) and not delivery.replayed:
+          delivered[(messagekey, delivery.shard)] = delivered.get((messagekey, delivery.shard), 0) + 1
+      db.put(deliveries)
+      for (messagekey, shard), count in delivered.items():
+        countdelivered(messagekey, shard, count)
+
+      # Delivered batches drop out of the query, so carry on with the
+      # next batch, unless this one failed (or was held back) or was the last
+      if status is None or status >= 400 or len(deliveries) < batchsize:
+        break
+
+    # If there are deliveries still to be made, come back
+    # when the earliest of them is due
+    nextdue = self._batched(subscriber).order('nextattempt').get()
+    if nextdue is not None and nextdue.nextattempt is not None:
+      countdown = max(0, timedelta_seconds(nextdue.nextattempt - datetime.datetime.now()))
+      enqueuedue(self.request.path, 'batch-%s' % (subscriberid, ), time.time() + countdown + 1)
+      logging.debug("Batch delivery to subscriber %s rescheduled in %d seconds" % (subscriberid, countdown))
+
+
+class ReplayWorker(webapp.RequestHandler):
+  """Task Queue worker - replays the next batch of a subscriber's
+  channel's messages to it, in sequence, and queues the task for the
+  batch after. A pull or batch subscriber is given the messages as
+  deliveries, as if they had just been published, but only once it has
+  caught up with those it already has. A push subscriber is sent them
+  directly, one at a time: the replay stops at the first that fails and
+  resumes from there after a backoff, dead-lettering it if it keeps
+  failing. Replayed deliveries aren't counted in the messages' delivery
+  counters.
+  """
+  def post(self, subscriberid):
+    subscriber = Subscriber.get_by_id(int(subscriberid))
+    if subscriber is None:
+      logging.debug("Subscriber %s does not exist, returning 200" % (subscriberid, ))
+      return
+    replayid = self.request.get('replay')
+    step = int(self.request.get('step') or 0) + 1
+    after = int(self.request.get('after'))
+    upto = int(self.request.get('upto'))
+    attempts = int(self.request.get('attempts') or 0)
+    now = datetime.datetime.now()
+
+    if subscriber.mode == MODE_PULL or subscriber.batchsize:
+      status = subscriber.mode == MODE_PULL and STATUS_PULL or STATUS_BATCHED
+      waiting = Delivery.all().filter('recipient =', subscriber).filter('status =', status).count(REPLAY_BATCH_SIZE)
+      if waiting >= REPLAY_BATCH_SIZE:
+        enqueuereplay(subscriberid, replayid, step, after, upto, 0, REPLAY_WAIT)
+        return
+      messages = self._messages(subscriber, after, upto)
+      self._hand(subscriber, messages, status, now)
+      if messages:
+        after = messages[-1].seq
 
-      # Make the delivery with a POST to the recipient's resource
-      # sending the published body, with the published body's content-type
-      status = 999
-      try:
-        result = urlfetch.fetch(
-          url = delivery.recipient.resource,
-          payload = message.body,
-          method = urlfetch.POST,
-          headers = { 'Content-Type': message.contenttype },
-          follow_redirects = False,
-        )
-        status = result.status_code
-      except: 
-        logging.error("urlfetch encountered an EXCEPTION")
-
-      # If we've had a successful status then consider this 
-      # particular delivery done. Otherwise, mark the delivery
-      # as failed.
-      if status < 400:
-        delivery.status = STATUS_DELIVERED
-        delivery.put()
-      else:
-        deliveriessucceeded = False
+    else:
+      # Messages go to the subscriber one at a time, in order, so the
+      # replay stops at the first that fails, and resumes from it after
+      # a backoff (or, if its host is being held back, once it may be
+      # tried again)
+      messages = self._messages(subscriber, after, upto)
+      deadline = time.time() + REPLAY_TIME
+      for message in messages:
+        if time.time() >= deadline:
+          break
+        status = postconcurrently([(subscriber.resource, message.body, { 'Content-Type': message.contenttype })])[0]
+        if status is None:
+          enqueuereplay(subscriberid, replayid, step, after, upto, attempts, retrydelay(subscriber.resource) + 1)
+          return
+        if status >= 400:
+          attempts += 1
+          if attempts < DELIVERY_MAX_ATTEMPTS:
+            enqueuereplay(subscriberid, replayid, step, after, upto, attempts, backoff(attempts))
+            return
+          logging.info("Replay of %s to subscriber %s dead-lettered after %d attempts" % (message.key(), subscriberid, attempts))
+          self._deadletter(subscriber, message, attempts, now)
+        after, attempts = message.seq, 0
+
+    if messages and after < upto:
+      enqueuereplay(subscriberid, replayid, step, after, upto)
+    else:
+      logging.info("Replay to subscriber %s finished at message %d" % (subscriberid, after))
+
+  def _messages(self, subscriber, after, upto):
+    """The next batch of the subscriber's channel's messages to replay"""
+    channelkey = Subscriber.channel.get_value_for_datastore(subscriber)
+    return (Message.all().filter('channel =', channelkey).filter('seq >', after)
+      .filter('seq <=', upto).order('seq').fetch(REPLAY_BATCH_SIZE))
+
+  def _deadletter(self, subscriber, message, attempts, now):
+    """Dead-letters the replay of a message to a push subscriber, unless
+    the message is still on its way to the subscriber from when it was
+    published
+    """
+    name = Delivery.deliveryname(message.key(), subscriber.key())
+    delivery = Delivery.get_by_key_name(name)
+    if delivery is None:
+      delivery = Delivery(key_name=name, message=message, recipient=subscriber, shard=0)
+    elif delivery.status not in (STATUS_DELIVERED, STATUS_DEADLETTER):
+      return
+    delivery.status = STATUS_DEADLETTER
+    delivery.attempts = attempts
+    delivery.nextattempt = now
+    delivery.replayed = True
+    delivery.put()
+
+  def _hand(self, subscriber, messages, status, now):
+    """Gives the messages to a pull or batch subscriber as deliveries
+    with the given status, reusing any it already has that are done
+    with, and leaving alone any still on their way from when the
+    messages were published
+    """
+    if not messages:
+      return
+    names = [Delivery.deliveryname(message.key(), subscriber.key()) for message in messages]
+    deliveries = []
+    for name, message, delivery in zip(names, messages, Delivery.get_by_key_name(names)):
+      if delivery is None:
+        delivery = Delivery(key_name=name, message=message, recipient=subscriber, shard=0)
+      elif delivery.status not in (STATUS_DELIVERED, STATUS_DEADLETTER):
+        continue
+      delivery.status = status
+      delivery.attempts = 0
+      delivery.nextattempt = now
+      delivery.replayed = True
+      deliveries.append(delivery)
+    db.put(deliveries)
+    if status == STATUS_BATCHED:
+      enqueuebatchdelivery(subscriber.key(), subscriber.batchwait or 0, len(deliveries) >= subscriber.batchsize)
+
+
+class SequencerWorker(webapp.RequestHandler):
+  """Task Queue worker - numbers a channel's newly stored messages, for
+  batch and asynchronous publishes, and for when the request that stored
+  them found another sequencer at work
+  """
+  def post(self, channelid):
+    channelkey = db.Key.from_path('Channel', int(channelid))
+    lease = 'seq-%s' % (channelid, )
+    if not acquirelease(lease):
+      enqueuesequencer(channelkey, WORKER_LEASE_RETRY)
+      return
+    try:
+      numbered = sequencemessages(channelkey)
+    finally:
+      releaselease(lease)
+    logging.debug("Numbered %d messages of channel %s" % (numbered, channelid))
+
+    # A message stored since the last look, whose publisher found this
+    # task already queued, is numbered by another
+    if unsequenced(channelkey):
+      enqueuesequencer(channelkey)
+
+
+class CompactionWorker(webapp.RequestHandler):
+  """Cron and Task Queue worker - enforces channels' message retention.
+  A GET (from cron) queues a compaction task for each channel that has a
+  retention limit. Each of those purges a batch of the channel's fully
+  delivered messages, first those in buckets past its maximum age, then
+  those beyond its maximum number, and re-queues itself while there are
+  more to look at.
+  """
+  def get(self):
+    from google.appengine.api.labs import taskqueue
+    tasks = []
+    query = Channel.all()
+    while True:
+      channels = query.fetch(COMPACTION_BATCH_SIZE)
+      for channel in channels:
+        maxage, maxcount = retention(channel)
+        if maxage or maxcount:
+          tasks.append(taskqueue.Task(url='/compactor/%d' % (channel.key().id(), )))
+      if len(channels) < COMPACTION_BATCH_SIZE:
+        break
+      query.with_cursor(query.cursor())
+    addtasks(tasks)
+    logging.info("Compaction queued for %d channels" % (len(tasks), ))
+
+  def _expired(self, channel, policy):
+    """Query for the channel's messages that are past the given retention
+    limit, or None if it has no such limit (or nothing is past it)
+    """
+    maxage, maxcount = retention(channel)
+    query = Message.all().filter('channel =', channel)
+    if policy == 'age' and maxage:
+      cutoff = messagebucket(datetime.datetime.now() - datetime.timedelta(seconds=maxage))
+      return query.filter('bucket <', cutoff).order('bucket')
+    if policy == 'count' and maxcount and lastseq(channel.key()) > maxcount:
+      return query.filter('seq <=', lastseq(channel.key()) - maxcount).order('seq')
+
+  def post(self, channelid):
+    from google.appengine.api.labs import taskqueue
+    channel = Channel.get_by_id(int(channelid))
+    if channel is None:
+      logging.debug("Channel %s does not exist, returning 200" % (channelid, ))
+      return
+
+    policy = self.request.get('policy') or 'age'
+    query = self._expired(channel, policy)
+    if query is None and policy == 'age':
+      policy = 'count'
+      query = self._expired(channel, policy)
+    if query is None:
+      return
 
-    # If there are failed deliveries, mark this task as failed
-    # so that the task queue mechanism will retry.
-    if not deliveriessucceeded:
-      self.response.set_status(500)
+    cursor = self.request.get('cursor')
+    if cursor:
+      query.with_cursor(cursor)
+    messages = query.fetch(COMPACTION_BATCH_SIZE)
+    purged = purgemessages(messages)
+    logging.info("Purged %d of %d messages of channel %s past its %s limit" % (purged, len(messages), channelid, policy))
+
+    # Messages not yet fully delivered are kept, so carry on from
+    # after this batch rather than from the start
+    if len(messages) == COMPACTION_BATCH_SIZE:
+      taskqueue.Task(url=self.request.path, params={ 'policy': policy, 'cursor': query.cursor() }).add(QUEUE_DISTRIBUTION)
+    elif policy == 'age':
+      taskqueue.Task(url=self.request.path, params={ 'policy': 'count' }).add(QUEUE_DISTRIBUTION)
+
+
+# The application is built once, when the module is first imported, and
+# then serves every request the process handles. On App Engine, main()
+# is re-run per request against this cached module; elsewhere, any WSGI
+# server can host coffeeshop.application directly
+application = webapp.WSGIApplication([
+  (r'/', MainPageHandler),
+  (r'/_ah/warmup', WarmupHandler),
+  (r'/channel/submissionform/?', ChannelSubmissionformHandler),
+  (r'/channel/(.+?)/subscriber/submissionform', ChannelSubscriberSubmissionformHandler),
+  (r'/channel/(.+?)/subscriber/', ChannelSubscriberContainerHandler),
+  (r'/channel/(.+?)/subscriber/(.+?)/messages', SubscriberMessagesHandler),
+  (r'/channel/(.+?)/subscriber/(.+?)/replay', SubscriberReplayHandler),
+  (r'/channel/(.+?)/subscriber/(.+?)/', ChannelSubscriberHandler),
+  (r'/channel/(.+?)/message/submissionform/?', ChannelMessageSubmissionformHandler),
+  (r'/channel/(.+?)/message/(.+)', ChannelMessageHandler),
+  (r'/channel/(.+?)/message/', ChannelMessageContainerHandler),
+  (r'/channel/(.+?)/stream', ChannelStreamHandler),
+  (r'/channel/(.+?)/', ChannelHandler),
+  (r'/channel/?', ChannelContainerHandler),
+  (r'/subscriber/', SubscriberContainerHandler),
+  (r'/message/', MessageHandler),
+  (r'/deadletter/', DeadLetterHandler),
+  (r'/fanout/(.+)', FanoutWorker),
+  (r'/batcher/(\d+)', BatchDeliveryWorker),
+  (r'/replayer/(\d+)', ReplayWorker),
+  (r'/sequencer/(\d+)', SequencerWorker),
+  (r'/compactor/', CompactionWorker),
+  (r'/compactor/(\d+)', CompactionWorker),
+  (r'/distributor/(.+?)/(\d+)', DistributorWorker),
+  (r'/distributor/(.+?)', DistributorWorker),
+], debug=DEBUG)
 
 
 def main():
-  application = webapp.WSGIApplication([
-    (r'/', MainPageHandler),
-    (r'/channel/submissionform/?', ChannelSubmissionformHandler),
-    (r'/channel/(.+?)/subscriber/submissionform', ChannelSubscriberSubmissionformHandler),
-    (r'/channel/(.+?)/subscriber/', ChannelSubscriberContainerHandler),
-    (r'/channel/(.+?)/subscriber/(.+?)/', ChannelSubscriberHandler),
-    (r'/channel/(.+?)/message/submissionform/?', ChannelMessageSubmissionformHandler),
-    (r'/channel/(.+?)/message/(.+)', ChannelMessageHandler),
-    (r'/channel/(.+?)/message/', ChannelMessageContainerHandler),
-    (r'/channel/(.+?)/', ChannelHandler),
-    (r'/channel/?', ChannelContainerHandler),
-    (r'/subscriber/', SubscriberContainerHandler),
-    (r'/message/', MessageHandler),
-    (r'/distributor/(.+?)', DistributorWorker),
-  ], debug=True)
   wsgiref.handlers.CGIHandler().run(application)
 
 
@@ -2,7 +2,7 @@
 
 CHUNK = 200
 
-from google.appengine.ext import db
+from storage import db
 from models import Channel, Subscriber, Message, Delivery
 
 def delete_all_deliveries():
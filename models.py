@@ -1,23 +1,129 @@
-from google.appengine.ext import db
+import struct
+
+from storage import db
 
 class Channel(db.Model):
   name = db.StringProperty()
+  compact = db.BooleanProperty(default=False)
+  maxage = db.IntegerProperty()
+  maxcount = db.IntegerProperty()
   created = db.DateTimeProperty(auto_now_add=True)
 
 class Subscriber(db.Model):
   name = db.StringProperty()
   channel = db.ReferenceProperty(Channel)
   resource = db.StringProperty()
+  mode = db.StringProperty(default='push')
+  batchsize = db.IntegerProperty(default=0)
+  batchwait = db.IntegerProperty(default=0)
   created = db.DateTimeProperty(auto_now_add=True)
 
 class Message(db.Model):
   contenttype = db.StringProperty()
   body = db.BlobProperty()
   channel = db.ReferenceProperty(Channel)
+  recipients = db.IntegerProperty(default=0)
+  shards = db.IntegerProperty(default=0)
+  compact = db.BooleanProperty(default=False)
+  seq = db.IntegerProperty()
+  bucket = db.IntegerProperty()
   created = db.DateTimeProperty(auto_now_add=True)
 
+class ChannelSequence(db.Model):
+  """The last sequence number allocated to a message published to a
+  channel, and the last visible to readers, all messages up to which
+  have been numbered. Keyed by sequencename(), so it can be read and
+  updated in a transaction without a query; kept apart from the channel
+  itself so that publishing doesn't contend with updates to it.
+  """
+  last = db.IntegerProperty(default=0)
+  visible = db.IntegerProperty(default=0)
+
+  @staticmethod
+  def sequencename(channelkey):
+    return str(channelkey.id())
+
 class Delivery(db.Model):
   message = db.ReferenceProperty(Message)
   recipient = db.ReferenceProperty(Subscriber)
+  shard = db.IntegerProperty()
   status = db.StringProperty()
+  attempts = db.IntegerProperty(default=0)
+  nextattempt = db.DateTimeProperty()
+  # A replayed delivery isn't one of the message's recipients, so isn't
+  # counted in its delivery counters
+  replayed = db.BooleanProperty(default=False)
+  created = db.DateTimeProperty(auto_now_add=True)
   updated = db.DateTimeProperty(auto_now=True)
+
+  @staticmethod
+  def deliveryname(messagekey, subscriberkey):
+    return "%s:%d" % (messagekey, subscriberkey.id())
+
+class DeliveryCounter(db.Model):
+  """Number of deliveries made for one distribution shard of a message.
+  Keyed by countername() so the counters for a message can be fetched
+  without a query, and sharded so parallel distribution tasks don't
+  contend on a single counter.
+  """
+  delivered = db.IntegerProperty(default=0)
+
+  @staticmethod
+  def countername(messagekey, shard):
+    return "%s:%d" % (messagekey, shard or 0)
+
+
+class DeliveryShard(db.Model):
+  """Delivery state for one distribution shard of a message published
+  to a compact channel, in place of a Delivery per recipient: the shard's
+  recipients as a packed array of subscriber ids, and bitmaps of which
+  of them have been delivered to and which have failed. A recipient that
+  fails gets a Delivery of its own, which carries its retries from then on,
+  as does one that takes its messages in batches (and counts as failed
+  here, as far as the bitmaps go).
+  Keyed by shardname(), like DeliveryCounter.
+  """
+  message = db.ReferenceProperty(Message)
+  shard = db.IntegerProperty()
+  recipients = db.BlobProperty()
+  delivered = db.BlobProperty()
+  failed = db.BlobProperty()
+  created = db.DateTimeProperty(auto_now_add=True)
+  updated = db.DateTimeProperty(auto_now=True)
+
+  @staticmethod
+  def shardname(messagekey, shard):
+    return "%s:%d" % (messagekey, shard or 0)
+
+  @staticmethod
+  def create(message, shard, subscriberkeys):
+    bitmap = '\0' * ((len(subscriberkeys) + 7) / 8)
+    return DeliveryShard(
+      key_name = DeliveryShard.shardname(message.key(), shard),
+      message = message,
+      shard = shard,
+      recipients = struct.pack('>%dq' % len(subscriberkeys), *[key.id() for key in subscriberkeys]),
+      delivered = bitmap,
+      failed = bitmap,
+    )
+
+  def recipientkeys(self):
+    ids = struct.unpack('>%dq' % (len(self.recipients) / 8), self.recipients)
+    return [db.Key.from_path('Subscriber', id) for id in ids]
+
+  def isdelivered(self, index):
+    return ord(self.delivered[index / 8]) & (1 << index % 8) != 0
+
+  def isfailed(self, index):
+    return ord(self.failed[index / 8]) & (1 << index % 8) != 0
+
+  def markdelivered(self, index):
+    self.delivered = _setbit(self.delivered, index)
+
+  def markfailed(self, index):
+    self.failed = _setbit(self.failed, index)
+
+
+def _setbit(bitmap, index):
+  byte = index / 8
+  return bitmap[:byte] + chr(ord(bitmap[byte]) | (1 << index % 8)) + bitmap[byte + 1:]
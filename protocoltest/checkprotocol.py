@@ -41,9 +41,12 @@ def log(message, callhier=1):
     logger.debug("%s: %s" % (caller, message))
 
 
-def newChannel(conn, name="Channel A"):
+def newChannel(conn, name="Channel A", compact=False):
   """Creates new channel via POST to the /channel/ resource"""
-  data = urllib.urlencode({ 'name': name })
+  params = { 'name': name }
+  if compact:
+    params['compact'] = '1'
+  data = urllib.urlencode(params)
   conn.request("POST", "/channel/", data)
   res = conn.getresponse()
   location = res.getheader('Location')
@@ -51,9 +54,12 @@ def newChannel(conn, name="Channel A"):
   log("created channel %s (%s)" % (location, name), 2)
   return (res.status, location, idsearch.group(1))
 
-def newSubscriber(conn, cid, name="Subscriber A", resource="http://localhost"):
+def newSubscriber(conn, cid, name="Subscriber A", resource="http://localhost", mode=None):
   """Creates new subscriber via POST to the given channel's resource"""
-  data = urllib.urlencode({ 'name': name, 'resource': resource })
+  params = { 'name': name, 'resource': resource }
+  if mode:
+    params['mode'] = mode
+  data = urllib.urlencode(params)
   conn.request("POST", "/channel/%s/subscriber/" % cid, data)
   res = conn.getresponse()
   location = res.getheader('Location')
@@ -61,13 +67,13 @@ def newSubscriber(conn, cid, name="Subscriber A", resource="http://localhost"):
   log("created subscriber %s" % location, 2)
   return (res.status, location, idsearch.group(1))
 
-def newMessage(conn, cid, message="the message"):
+def newMessage(conn, cid, message="the message", headers={}):
   """Publishes a new message to the given channel"""
   data = message
-  conn.request("POST", "/channel/%s/" % cid, data)
+  conn.request("POST", "/channel/%s/" % cid, data, headers)
   res = conn.getresponse()
   log("created message for channel %s : %s" % (cid, res.status), 2)
-  if res.status == 201:
+  if res.status in (201, 202):
     location = res.getheader('Location')
     idsearch = re.search(MESSAGE, location)
     return (res.status, location, idsearch.group(1))
@@ -219,6 +225,77 @@ class ChannelTests(unittest.TestCase):
     self.assertEquals(deleteres.status, 405)
     self.failIf(deleteres.getheader('Allow') is None)
 
+  def testChannelStream(self):
+    """A channel's messages can be long-polled and streamed as events"""
+
+    # GET /channel/{cid}/stream
+
+    # Create a channel, and publish a message to it
+    status, location, cid = newChannel(self.conn, myfuncname())
+    mstatus, mlocation, mid = newMessage(self.conn, cid, myfuncname())
+    self.assertEqual(mstatus, 201)
+
+    # Long-poll from the beginning, expect the message
+    self.conn.request("GET", "/channel/%s/stream?since=0&timeout=0" % cid)
+    res = self.conn.getresponse()
+    self.assertEqual(res.status, 200)
+    info = simplejson.loads(res.read())
+    self.assertEqual([m['key'] for m in info['messages']], [mid])
+    lastid = info['lastid']
+
+    # Long-poll from there, expect nothing new
+    self.conn.request("GET", "/channel/%s/stream?since=%s&timeout=0" % (cid, lastid))
+    res = self.conn.getresponse()
+    self.assertEqual(simplejson.loads(res.read())['messages'], [])
+
+    # Stream from the beginning as events, expect the message
+    self.conn.request("GET", "/channel/%s/stream?timeout=0" % cid, "",
+      {'Accept': 'text/event-stream', 'Last-Event-ID': '0'})
+    res = self.conn.getresponse()
+    self.assertEqual(res.status, 200)
+    self.assertTrue(res.getheader('Content-Type').startswith('text/event-stream'))
+    self.assertTrue(re.search('id: %s\n' % lastid, res.read()))
+
+  def testChannelStreamInvalidEventId(self):
+    """Get 400 when resuming a stream from an invalid event id"""
+
+    # GET /channel/{cid}/stream
+
+    status, location, cid = newChannel(self.conn, myfuncname())
+    self.conn.request("GET", "/channel/%s/stream?since=nonnumeric" % cid)
+    res = self.conn.getresponse()
+    self.assertEqual(res.status, 400)
+
+  def testChannelRetention(self):
+    """A channel can be created with its own retention limits"""
+
+    # POST /channel/
+
+    # Create a channel keeping at most two messages
+    name = myfuncname()
+    data = urllib.urlencode({ 'name': name, 'maxcount': '2', 'maxage': '3600' })
+    self.conn.request("POST", "/channel/", data)
+    res = self.conn.getresponse()
+    res.read()
+    self.assertEqual(res.status, 201)
+
+    # Expect the limits in the channel list
+    self.conn.request("GET", "/channel/", "", {'Accept': 'application/json'})
+    res = self.conn.getresponse()
+    channels = [c for c in simplejson.loads(res.read())['channels'] if c['name'] == name]
+    self.assertEqual((channels[0]['maxcount'], channels[0]['maxage']), (2, 3600))
+
+  def testCompactorIsNotPublic(self):
+    """Compaction is only run by cron and the task queue"""
+
+    # POST /compactor/{cid}
+
+    status, location, cid = newChannel(self.conn, myfuncname())
+    self.conn.request("POST", "/compactor/%s" % cid, "", {'Content-Type': 'application/x-www-form-urlencoded'})
+    res = self.conn.getresponse()
+    res.read()
+    self.assertNotEqual(res.status, 200)
+
     
 class SubscriberTests(unittest.TestCase):
   
@@ -370,6 +447,65 @@ class SubscriberTests(unittest.TestCase):
     self.assertEquals(deleteres.status, 405)
     self.failIf(deleteres.getheader('Allow') is None)
 
+  def testPullSubscriberMessages(self):
+    """A pull subscriber has a messages resource to pull from and ack to"""
+    # Create the channel first
+    cstatus, clocation, cid = newChannel(self.conn, myfuncname())
+    self.assertTrue(re.search(CHANNEL, clocation))
+
+    # Create the pull subscriber
+    sstatus, slocation, sid = newSubscriber(self.conn, cid, myfuncname(), "", 'pull')
+    self.assertEqual(sstatus, 201)
+
+    # Pull a batch of messages
+    self.conn.request("GET", "/channel/%s/subscriber/%s/messages" % (cid, sid))
+    res = self.conn.getresponse()
+    self.assertEqual(res.status, 200)
+    info = simplejson.loads(res.read())
+    self.assertTrue('messages' in info and 'cursor' in info)
+
+    # Acknowledge them
+    data = simplejson.dumps({'ack': [m['key'] for m in info['messages']]})
+    self.conn.request("POST", "/channel/%s/subscriber/%s/messages" % (cid, sid), data,
+      {'Content-Type': 'application/json'})
+    res = self.conn.getresponse()
+    self.assertEqual(res.status, 200)
+    self.assertEqual(simplejson.loads(res.read())['acknowledged'], len(info['messages']))
+
+  def testSubscriberReplay(self):
+    """A channel's past messages can be replayed to a subscriber"""
+    # Create the channel first, and publish to it
+    cstatus, clocation, cid = newChannel(self.conn, myfuncname())
+    for m in range(2):
+      mstatus, mlocation, mid = newMessage(self.conn, cid, myfuncname())
+
+    # Create the subscriber afterwards
+    sstatus, slocation, sid = newSubscriber(self.conn, cid, myfuncname(),
+      "http://%s/subscriber/%s" % (SUBROOT, myfuncname()), mode="pull")
+    self.assertEqual(sstatus, 201)
+
+    # A replay needs a starting point
+    self.conn.request("POST", "/channel/%s/subscriber/%s/replay" % (cid, sid), "", {'Content-Type': 'application/x-www-form-urlencoded'})
+    res = self.conn.getresponse()
+    res.read()
+    self.assertEqual(res.status, 400)
+
+    # Replay from the beginning, expect both messages
+    self.conn.request("POST", "/channel/%s/subscriber/%s/replay" % (cid, sid), "since=0", {'Content-Type': 'application/x-www-form-urlencoded'})
+    res = self.conn.getresponse()
+    self.assertEqual(res.status, 202)
+    info = simplejson.loads(res.read())
+    self.assertEqual((info['since'], info['upto'], info['messages']), (0, 2, 2))
+
+  def testPushSubscriberHasNoMessages(self):
+    """A push subscriber has no messages resource"""
+    cstatus, clocation, cid = newChannel(self.conn, myfuncname())
+    sstatus, slocation, sid = newSubscriber(self.conn, cid, myfuncname(), 
+      "http://%s/subscriber/%s" % (SUBROOT, myfuncname()))
+    self.conn.request("GET", "/channel/%s/subscriber/%s/messages" % (cid, sid))
+    res = self.conn.getresponse()
+    self.assertEqual(res.status, 404)
+
 
 class MessageTests(unittest.TestCase):
   
@@ -413,6 +549,45 @@ class MessageTests(unittest.TestCase):
     # Check status is 201
     self.assertEqual(mstatus, 201)
 
+  def testAsyncMessageCreation(self):
+    """A message published asynchronously gives a 202 and a Location"""
+    # Create the channel first
+    cstatus, clocation, cid = newChannel(self.conn, myfuncname())
+    self.assertTrue(re.search(CHANNEL, clocation))
+
+    # Create the subscriber
+    sstatus, slocation, sid = newSubscriber(self.conn, cid, myfuncname(), 
+      "http://%s/subscriber/%s" % (SUBROOT, myfuncname()))
+    self.assertEqual(sstatus, 201)
+
+    # Publish a message, asking for it to be fanned out asynchronously
+    mstatus, mlocation, mid = newMessage(self.conn, cid, myfuncname(),
+      {'Prefer': 'respond-async'})
+
+    # Check status is 202, and Location header exists
+    self.assertEqual(mstatus, 202)
+    self.assertTrue(re.search(MESSAGE, mlocation))
+
+  def testBatchMessageCreation(self):
+    """A batch of messages can be published in one request"""
+    # Create the channel first
+    cstatus, clocation, cid = newChannel(self.conn, myfuncname())
+    self.assertTrue(re.search(CHANNEL, clocation))
+
+    # Publish a JSON array of three messages, and then three lines
+    for data, contenttype in [('[{"n": 1}, {"n": 2}, {"n": 3}]', 'application/json'),
+                              ('one\ntwo\nthree\n', 'text/plain')]:
+      self.conn.request("POST", "/channel/%s/?batch=1" % cid, data,
+        {'Content-Type': contenttype})
+      res = self.conn.getresponse()
+
+      # Check status is 202, and there's a location for each message
+      self.assertEqual(res.status, 202)
+      messages = simplejson.loads(res.read())['messages']
+      self.assertEqual(len(messages), 3)
+      for m in messages:
+        self.assertTrue(re.search(MESSAGE, m['resource']))
+
   def testMessageCreationLocation(self):
     """A message can be published to a channel and gets a Location"""
     # Create the channel first
@@ -493,6 +668,93 @@ class MessageTests(unittest.TestCase):
       self.assertTrue(re.search(MESSAGE, mlocation))
       self.assertEqual(mstatus, 201)
 
+  def testMessageSequence(self):
+    """Messages are numbered in sequence, and can be listed from any of them"""
+    # Create the channel first
+    cstatus, clocation, cid = newChannel(self.conn, myfuncname())
+    self.assertTrue(re.search(CHANNEL, clocation))
+
+    # Publish messages
+    mids = []
+    for m in range(3):
+      mstatus, mlocation, mid = newMessage(self.conn, cid, myfuncname())
+      mids.append(mid)
+
+    # List them, most recent first
+    self.conn.request("GET", "/channel/%s/message/" % cid, "", {'Accept': 'application/json'})
+    res = self.conn.getresponse()
+    messages = simplejson.loads(res.read())['messages']
+    self.assertEqual([m['seq'] for m in messages], [3, 2, 1])
+    self.assertEqual([m['key'] for m in messages], [mids[2], mids[1], mids[0]])
+
+    # List those after the first, in sequence
+    self.conn.request("GET", "/channel/%s/message/?since=1" % cid, "", {'Accept': 'application/json'})
+    res = self.conn.getresponse()
+    messages = simplejson.loads(res.read())['messages']
+    self.assertEqual([m['key'] for m in messages], mids[1:])
+
+  def testCompactMessageInfoAsJson(self):
+    """A message on a compact channel reports a delivery per subscriber"""
+    # Create the compact channel first
+    cstatus, clocation, cid = newChannel(self.conn, myfuncname(), compact=True)
+    self.assertTrue(re.search(CHANNEL, clocation))
+
+    # Create the subscribers
+    for s in range(3):
+      sstatus, slocation, sid = newSubscriber(self.conn, cid, "%s%d" % (myfuncname(), s),
+        "http://%s/subscriber/%s%d" % (SUBROOT, myfuncname(), s))
+      self.assertEqual(sstatus, 201)
+
+    # Publish a message
+    mstatus, mlocation, mid = newMessage(self.conn, cid, myfuncname())
+    self.assertEqual(mstatus, 201)
+
+    # Retrieve the message info, with its delivery report
+    self.conn.request("GET", mlocation, "", {'Accept': 'application/json'})
+    res = self.conn.getresponse()
+    self.assertEqual(res.status, 200)
+    info = simplejson.loads(res.read())
+    self.assertEqual(len(info['message']['delivery']), 3)
+
+
+
+class DeadLetterTests(unittest.TestCase):
+
+  def setUp(self):
+    self.conn = httplib.HTTPConnection(HUBROOT)
+
+  def tearDown(self):
+    self.conn = None
+
+  def testDeadLetterContainerExists(self):
+    """The dead letter container exists"""
+
+    # GET /deadletter/
+
+    self.conn.request("GET", "/deadletter/")
+    res = self.conn.getresponse()
+    self.assertEqual(res.status, 200)
+
+  def testDeadLetterAsJson(self):
+    """Dead letters are available as JSON if requested"""
+
+    # GET /deadletter/
+
+    self.conn.request("GET", "/deadletter/", "", {'Accept': 'application/json'})
+    res = self.conn.getresponse()
+    self.assertEqual(res.status, 200)
+    self.assertTrue('deadletters' in simplejson.loads(res.read()))
+
+  def testDeadLetterRedrive(self):
+    """Dead letters can be re-driven"""
+
+    # POST /deadletter/
+
+    self.conn.request("POST", "/deadletter/", "")
+    res = self.conn.getresponse()
+    self.assertEqual(res.status, 200)
+    self.assertTrue(re.search('re-driven', res.read()))
+
 
 if __name__ == '__main__':
   logger = logging.getLogger("unitlogger")
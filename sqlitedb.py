@@ -0,0 +1,757 @@
+# SQLite storage engine for coffeeshop
+# Implements the subset of the google.appengine.ext.db API that coffeeshop
+# uses (models, properties, keys, queries with cursors, batch operations
+# and transactions) on top of an SQLite database, so that coffeeshop can
+# be run and benchmarked off App Engine. Selected through storage.py,
+# which notes the other App Engine services coffeeshop still relies on.
+# Tested by storagetest/checksqlitedb.py.
+#
+# Each model kind is a table with a column per property. The database is
+# used in WAL mode, so readers don't block the writer, and it is indexed
+# with the composite indexes declared in index.yaml (i.e. for the exact
+# query shapes the handlers use) plus an index on each reference property
+# and each creation time (for the plain listings, most recent first).
+
+import base64
+import datetime
+import sqlite3
+import threading
+import time
+
+# Errors, named as in google.appengine.ext.db
+class Error(Exception): pass
+class BadKeyError(Error): pass
+class BadValueError(Error): pass
+class BadRequestError(Error): pass
+class KindError(Error): pass
+class NotSavedError(Error): pass
+class TransactionFailedError(Error): pass
+
+_path = None
+_indexes = {}
+_kinds = {}
+_tables = {}
+_local = threading.local()
+
+
+def configure(path, indexfile=None):
+  """Sets the path of the SQLite database, and the index.yaml file
+  from which to take its composite indexes
+  """
+  global _path, _indexes
+  _path = path
+  if indexfile is not None:
+    _indexes = readindexes(indexfile)
+
+
+def readindexes(path):
+  """Reads the composite indexes from an App Engine index.yaml, returning
+  a dict of kind to a list of indexes, each a list of (property name,
+  descending) pairs
+  """
+  indexes = {}
+  properties = None
+  for line in open(path):
+    line = line.split('#')[0].strip()
+    if line.startswith('- kind:'):
+      properties = []
+      indexes.setdefault(line.split(':', 1)[1].strip(), []).append(properties)
+    elif line.startswith('- name:') and properties is not None:
+      properties.append((line.split(':', 1)[1].strip(), False))
+    elif line.startswith('direction:') and properties:
+      properties[-1] = (properties[-1][0], line.split(':', 1)[1].strip() == 'desc')
+  return indexes
+
+
+def _connection():
+  """The calling thread's connection to the database"""
+  connection = getattr(_local, 'connection', None)
+  if connection is None:
+    if _path is None:
+      raise Error("sqlitedb has not been configured with a database path")
+    connection = sqlite3.connect(_path, timeout=30, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    _local.connection = connection
+    _local.intransaction = False
+    _local.newtables = []
+  return connection
+
+
+def _ensuretable(cls):
+  """Creates the table and indexes for a model kind if need be, adding
+  columns for any properties the model has gained since. The changes are
+  made under SQLite's own write lock, in the calling thread's transaction
+  if it is in one, so they can't wait on a thread that is itself waiting
+  for the schema; a kind created in a transaction is only noted once
+  that transaction commits.
+  """
+  kind = cls.kind()
+  if kind in _tables:
+    return
+
+  def create(connection):
+    columns = ['_id INTEGER PRIMARY KEY AUTOINCREMENT', '_name TEXT UNIQUE']
+    for name, prop in cls._properties.items():
+      columns.append('"%s" %s' % (name, prop.coltype))
+    connection.execute('CREATE TABLE IF NOT EXISTS "%s" (%s)' % (kind, ', '.join(columns)))
+    existing = [row[1] for row in connection.execute('PRAGMA table_info("%s")' % (kind, ))]
+    for name, prop in cls._properties.items():
+      if name not in existing:
+        connection.execute('ALTER TABLE "%s" ADD COLUMN "%s" %s' % (kind, name, prop.coltype))
+
+    indexes = []
+    for name, prop in cls._properties.items():
+      if isinstance(prop, ReferenceProperty) or getattr(prop, 'auto_now_add', False):
+        indexes.append([(name, False)])
+    indexes.extend(_indexes.get(kind, []))
+    for index in indexes:
+      connection.execute('CREATE INDEX IF NOT EXISTS "%s" ON "%s" (%s)' % (
+        '_'.join(['idx', kind] + [name for name, descending in index]), kind,
+        ', '.join(['"%s"%s' % (name, descending and ' DESC' or '') for name, descending in index])))
+
+  _write(create)
+  if _local.intransaction:
+    _local.newtables.append(kind)
+  else:
+    _tables[kind] = True
+
+
+def _write(function):
+  """Calls function with the connection inside a transaction, which is
+  the current one if there is one, or one of its own otherwise
+  """
+  connection = _connection()
+  if _local.intransaction:
+    return function(connection)
+  connection.execute('BEGIN IMMEDIATE')
+  _local.intransaction = True
+  _local.newtables = []
+  try:
+    result = function(connection)
+  except:
+    _local.intransaction = False
+    connection.execute('ROLLBACK')
+    raise
+  _local.intransaction = False
+  connection.execute('COMMIT')
+  for kind in _local.newtables:
+    _tables[kind] = True
+  return result
+
+
+class Key(object):
+  """Identifies an entity by kind and either numeric id or key name.
+  The string form is URL safe, and can be turned back into a Key with
+  Key(encoded)
+  """
+  def __init__(self, encoded=None):
+    self._kind = self._id = self._name = None
+    if encoded is None:
+      return
+    try:
+      encoded = str(encoded)
+      raw = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+      kind, type, value = raw.split('\x00', 2)
+      if type == 'i':
+        self._id = int(value)
+      elif type == 'n':
+        self._name = value.decode('utf-8')
+      else:
+        raise ValueError(type)
+      self._kind = kind
+    except (TypeError, ValueError, UnicodeError):
+      raise BadKeyError("Invalid string key %s." % (encoded, ))
+
+  def from_path(kind, id_or_name):
+    key = Key()
+    key._kind = kind
+    if isinstance(id_or_name, (int, long)):
+      key._id = id_or_name
+    else:
+      key._name = id_or_name
+    return key
+  from_path = staticmethod(from_path)
+
+  def kind(self):
+    return self._kind
+
+  def id(self):
+    return self._id
+
+  def name(self):
+    return self._name
+
+  def id_or_name(self):
+    if self._id is not None:
+      return self._id
+    return self._name
+
+  def __str__(self):
+    if self._id is not None:
+      raw = '%s\x00i\x00%d' % (self._kind, self._id)
+    else:
+      raw = '%s\x00n\x00%s' % (self._kind, self._name.encode('utf-8'))
+    return base64.urlsafe_b64encode(raw).rstrip('=')
+
+  def __repr__(self):
+    return "Key.from_path(%r, %r)" % (self._kind, self.id_or_name())
+
+  def __cmp__(self, other):
+    if not isinstance(other, Key):
+      return -1
+    return cmp((self._kind, self._id, self._name), (other._kind, other._id, other._name))
+
+  def __hash__(self):
+    return hash((self._kind, self._id, self._name))
+
+
+class Property(object):
+  """A model property, held in a column of the model kind's table"""
+  coltype = 'TEXT'
+
+  def __init__(self, verbose_name=None, default=None, required=False, indexed=True):
+    self.name = None
+    self.default = default
+
+  def default_value(self):
+    return self.default
+
+  def __get__(self, instance, owner):
+    if instance is None:
+      return self
+    return instance._values.get(self.name)
+
+  def __set__(self, instance, value):
+    instance._values[self.name] = self.validate(value)
+
+  def validate(self, value):
+    return value
+
+  def get_value_for_datastore(self, instance):
+    return instance._values.get(self.name)
+
+  def todb(self, value):
+    """Converts a property value to its column value"""
+    return value
+
+  def fromdb(self, value):
+    """Converts a column value back to a property value"""
+    return value
+
+
+class StringProperty(Property):
+  pass
+
+
+class TextProperty(Property):
+  pass
+
+
+class IntegerProperty(Property):
+  coltype = 'INTEGER'
+
+  def validate(self, value):
+    if value is not None and not isinstance(value, (int, long)):
+      raise BadValueError("Property %s must be an int or long" % (self.name, ))
+    return value
+
+
+class BooleanProperty(Property):
+  coltype = 'INTEGER'
+
+  def todb(self, value):
+    if value is None:
+      return None
+    return int(bool(value))
+
+  def fromdb(self, value):
+    if value is None:
+      return None
+    return bool(value)
+
+
+class BlobProperty(Property):
+  coltype = 'BLOB'
+
+  def todb(self, value):
+    if value is None:
+      return None
+    return sqlite3.Binary(value)
+
+  def fromdb(self, value):
+    if value is None:
+      return None
+    return str(value)
+
+
+class DateTimeProperty(Property):
+  """Held as an ISO 8601 string, which sorts in time order"""
+  def __init__(self, verbose_name=None, auto_now=False, auto_now_add=False, **kwds):
+    Property.__init__(self, verbose_name, **kwds)
+    self.auto_now = auto_now
+    self.auto_now_add = auto_now_add
+
+  def default_value(self):
+    if self.auto_now or self.auto_now_add:
+      return datetime.datetime.now()
+    return Property.default_value(self)
+
+  def todb(self, value):
+    if value is None:
+      return None
+    return value.isoformat(' ')
+
+  def fromdb(self, value):
+    if value is None:
+      return None
+    seconds, microseconds = (value.split('.') + ['0'])[:2]
+    return datetime.datetime(*(time.strptime(seconds, '%Y-%m-%d %H:%M:%S')[:6] +
+      (int(microseconds.ljust(6, '0')), )))
+
+
+class ReferenceProperty(Property):
+  """A reference to another entity, held as its key string. Reading the
+  property returns the referenced entity, fetched on first access.
+  """
+  def __init__(self, reference_class=None, verbose_name=None, collection_name=None, **kwds):
+    Property.__init__(self, verbose_name, **kwds)
+    self.reference_class = reference_class
+
+  def __get__(self, instance, owner):
+    if instance is None:
+      return self
+    key = instance._values.get(self.name)
+    if key is None:
+      return None
+    resolved = instance._resolved.get(self.name)
+    if resolved is None:
+      resolved = get(key)
+      if resolved is None:
+        raise Error("ReferenceProperty failed to be resolved")
+      instance._resolved[self.name] = resolved
+    return resolved
+
+  def __set__(self, instance, value):
+    Property.__set__(self, instance, value)
+    instance._resolved.pop(self.name, None)
+    if isinstance(value, Model):
+      instance._resolved[self.name] = value
+
+  def validate(self, value):
+    if isinstance(value, Model):
+      value = value.key()
+    if value is not None and not isinstance(value, Key):
+      raise BadValueError("Property %s must be a model instance or key" % (self.name, ))
+    return value
+
+  def todb(self, value):
+    if value is None:
+      return None
+    return str(value)
+
+  def fromdb(self, value):
+    if value is None:
+      return None
+    return Key(value)
+
+
+class PropertiedClass(type):
+  """Metaclass that names a model's properties and registers its kind"""
+  def __init__(cls, name, bases, attrs):
+    super(PropertiedClass, cls).__init__(name, bases, attrs)
+    cls._properties = {}
+    for base in bases:
+      cls._properties.update(getattr(base, '_properties', {}))
+    for attr, value in attrs.items():
+      if isinstance(value, Property):
+        value.name = attr
+        cls._properties[attr] = value
+    _kinds[name] = cls
+
+
+class Model(object):
+  __metaclass__ = PropertiedClass
+
+  def __init__(self, key_name=None, **kwds):
+    self._key = None
+    self._key_name = key_name
+    self._values = {}
+    self._resolved = {}
+    for name, prop in self._properties.items():
+      if name in kwds:
+        setattr(self, name, kwds[name])
+      else:
+        self._values[name] = prop.default_value()
+
+  def kind(cls):
+    return cls.__name__
+  kind = classmethod(kind)
+
+  def key(self):
+    if self._key is not None:
+      return self._key
+    if self._key_name is not None:
+      return Key.from_path(self.kind(), self._key_name)
+    raise NotSavedError("%s has not been saved" % (self.kind(), ))
+
+  def is_saved(self):
+    return self._key is not None
+
+  def put(self):
+    return put(self)
+
+  def delete(self):
+    delete(self)
+
+  def _put(self, connection):
+    cls = self.__class__
+    _ensuretable(cls)
+    for name, prop in cls._properties.items():
+      if isinstance(prop, DateTimeProperty) and prop.auto_now:
+        self._values[name] = datetime.datetime.now()
+    names = cls._properties.keys()
+    values = [cls._properties[name].todb(self._values.get(name)) for name in names]
+    columns = ', '.join(['"%s"' % (name, ) for name in names])
+    placeholders = ', '.join(['?'] * len(names))
+
+    if self._key is None and self._key_name is not None:
+      row = connection.execute('SELECT _id FROM "%s" WHERE _name = ?' % (cls.kind(), ),
+        (self._key_name, )).fetchone()
+      if row is not None:
+        connection.execute('REPLACE INTO "%s" (_id, _name, %s) VALUES (?, ?, %s)' % (
+          cls.kind(), columns, placeholders), [row[0], self._key_name] + values)
+      else:
+        connection.execute('INSERT INTO "%s" (_name, %s) VALUES (?, %s)' % (
+          cls.kind(), columns, placeholders), [self._key_name] + values)
+      self._key = Key.from_path(cls.kind(), self._key_name)
+    elif self._key is not None and self._key.name() is not None:
+      connection.execute('UPDATE "%s" SET %s WHERE _name = ?' % (cls.kind(),
+        ', '.join(['"%s" = ?' % (name, ) for name in names])), values + [self._key.name()])
+    elif self._key is not None:
+      connection.execute('REPLACE INTO "%s" (_id, %s) VALUES (?, %s)' % (
+        cls.kind(), columns, placeholders), [self._key.id()] + values)
+    else:
+      cursor = connection.execute('INSERT INTO "%s" (%s) VALUES (%s)' % (
+        cls.kind(), columns, placeholders), values)
+      self._key = Key.from_path(cls.kind(), cursor.lastrowid)
+    return self._key
+
+  def _fromrow(cls, columns, row):
+    """Makes an entity from a table row"""
+    entity = cls.__new__(cls)
+    entity._values = {}
+    entity._resolved = {}
+    entity._key_name = row[1]
+    if row[1] is not None:
+      entity._key = Key.from_path(cls.kind(), row[1])
+    else:
+      entity._key = Key.from_path(cls.kind(), row[0])
+    for column, value in zip(columns[2:], row[2:]):
+      prop = cls._properties.get(column)
+      if prop is not None:
+        if value is None:
+          entity._values[column] = prop.default
+        else:
+          entity._values[column] = prop.fromdb(value)
+    for name, prop in cls._properties.items():
+      if name not in entity._values:
+        entity._values[name] = prop.default
+    return entity
+  _fromrow = classmethod(_fromrow)
+
+  def all(cls, keys_only=False):
+    return Query(cls, keys_only)
+  all = classmethod(all)
+
+  def get(cls, keys):
+    entities = get(keys)
+    for entity in isinstance(entities, list) and entities or [entities]:
+      if entity is not None and not isinstance(entity, cls):
+        raise KindError("Kind %s is not a kind of %s" % (entity.kind(), cls.kind()))
+    return entities
+  get = classmethod(get)
+
+  def get_by_id(cls, ids):
+    if isinstance(ids, (list, tuple)):
+      return get([Key.from_path(cls.kind(), id) for id in ids])
+    return get(Key.from_path(cls.kind(), ids))
+  get_by_id = classmethod(get_by_id)
+
+  def get_by_key_name(cls, key_names):
+    if isinstance(key_names, (list, tuple)):
+      return get([Key.from_path(cls.kind(), name) for name in key_names])
+    return get(Key.from_path(cls.kind(), key_names))
+  get_by_key_name = classmethod(get_by_key_name)
+
+
+def _tokey(value):
+  if isinstance(value, Model):
+    return value.key()
+  if isinstance(value, Key):
+    return value
+  return Key(value)
+
+
+def get(keys):
+  """Fetches the entities for a key or list of keys (or key strings),
+  returning None in place of those that don't exist
+  """
+  multiple = isinstance(keys, (list, tuple))
+  if not multiple:
+    keys = [keys]
+  keys = [_tokey(key) for key in keys]
+  connection = _connection()
+  found = {}
+  bykind = {}
+  for key in keys:
+    bykind.setdefault(key.kind(), []).append(key)
+  for kind, kindkeys in bykind.items():
+    cls = _kinds.get(kind)
+    if cls is None:
+      raise KindError("No implementation for kind %s" % (kind, ))
+    _ensuretable(cls)
+    for column, values in [('_id', [k.id() for k in kindkeys if k.id() is not None]),
+                           ('_name', [k.name() for k in kindkeys if k.name() is not None])]:
+      for start in range(0, len(values), 500):
+        chunk = values[start:start + 500]
+        cursor = connection.execute('SELECT * FROM "%s" WHERE %s IN (%s)' % (
+          kind, column, ', '.join(['?'] * len(chunk))), chunk)
+        columns = [d[0] for d in cursor.description]
+        for row in cursor:
+          entity = cls._fromrow(columns, row)
+          found[entity.key()] = entity
+  entities = [found.get(key) for key in keys]
+  if multiple:
+    return entities
+  return entities[0]
+
+
+def put(models):
+  """Stores a model instance or list of them, in one transaction"""
+  multiple = isinstance(models, (list, tuple))
+  if not multiple:
+    models = [models]
+  keys = _write(lambda connection: [model._put(connection) for model in models])
+  if multiple:
+    return keys
+  return keys[0]
+
+
+def delete(models):
+  """Deletes the entities for a model instance, key or list of them"""
+  if not isinstance(models, (list, tuple)):
+    models = [models]
+  keys = [_tokey(model) for model in models]
+
+  def remove(connection):
+    for key in keys:
+      cls = _kinds.get(key.kind())
+      if cls is None:
+        continue
+      _ensuretable(cls)
+      if key.id() is not None:
+        connection.execute('DELETE FROM "%s" WHERE _id = ?' % (key.kind(), ), (key.id(), ))
+      else:
+        connection.execute('DELETE FROM "%s" WHERE _name = ?' % (key.kind(), ), (key.name(), ))
+  _write(remove)
+
+
+def run_in_transaction(function, *args, **kwargs):
+  """Calls function in a transaction, committing what it writes if it
+  returns and rolling it back if it raises. SQLite serialises writers,
+  so unlike the datastore there is no contention to retry on.
+  """
+  _connection()
+  if _local.intransaction:
+    raise BadRequestError("Nested transactions are not supported.")
+  return _write(lambda connection: function(*args, **kwargs))
+
+
+def run_in_transaction_custom_retries(retries, function, *args, **kwargs):
+  return run_in_transaction(function, *args, **kwargs)
+
+
+def _encodecursor(values):
+  """Encodes a query position (a list of column values) as a URL safe string"""
+  parts = []
+  for value in values:
+    if value is None:
+      parts.append('n')
+    elif isinstance(value, (int, long)):
+      parts.append('i%d' % (value, ))
+    elif isinstance(value, float):
+      parts.append('f%r' % (value, ))
+    else:
+      if isinstance(value, unicode):
+        value = value.encode('utf-8')
+      parts.append('s' + base64.urlsafe_b64encode(str(value)))
+  return base64.urlsafe_b64encode('.'.join(parts))
+
+
+def _decodecursor(cursor):
+  try:
+    cursor = str(cursor)
+    values = []
+    for part in base64.urlsafe_b64decode(cursor).split('.'):
+      if part == 'n':
+        values.append(None)
+      elif part[0] == 'i':
+        values.append(int(part[1:]))
+      elif part[0] == 'f':
+        values.append(float(part[1:]))
+      elif part[0] == 's':
+        values.append(base64.urlsafe_b64decode(part[1:]).decode('utf-8'))
+      else:
+        raise ValueError(part)
+    return values
+  except (TypeError, ValueError, IndexError, UnicodeError):
+    raise BadValueError("Invalid cursor %s" % (cursor, ))
+
+
+class Query(object):
+  """A query on a model kind, with equality and inequality filters, sort
+  orders, and cursors. Results are always ordered by the sort orders and
+  then by id, and a cursor records the position of the last result in
+  that order, so paging stays correct while entities are being changed.
+  """
+  OPERATORS = ['=', '!=', '<', '<=', '>', '>=']
+
+  def __init__(self, model_class, keys_only=False):
+    self._model_class = model_class
+    self._keys_only = keys_only
+    self._filters = []
+    self._params = []
+    self._orders = []
+    self._position = None
+    self._last = None
+
+  def filter(self, property_operator, value):
+    parts = property_operator.split()
+    if len(parts) == 1:
+      parts.append('=')
+    name, operator = parts
+    prop = self._model_class._properties.get(name)
+    if prop is None or operator not in self.OPERATORS:
+      raise BadRequestError("Unsupported filter %s" % (property_operator, ))
+    value = prop.todb(prop.validate(value))
+    if value is None:
+      if operator == '=':
+        self._filters.append('"%s" IS NULL' % (name, ))
+      elif operator == '!=':
+        self._filters.append('"%s" IS NOT NULL' % (name, ))
+      else:
+        raise BadValueError("Inequality filter on %s with None" % (name, ))
+    elif operator == '!=':
+      self._filters.append('("%s" IS NULL OR "%s" != ?)' % (name, name))
+      self._params.append(value)
+    else:
+      self._filters.append('"%s" %s ?' % (name, operator))
+      self._params.append(value)
+    return self
+
+  def order(self, property):
+    descending = property.startswith('-')
+    name = property.lstrip('-')
+    if name not in self._model_class._properties:
+      raise BadRequestError("Unsupported order %s" % (property, ))
+    self._orders.append((name, descending))
+    return self
+
+  def with_cursor(self, cursor):
+    if cursor:
+      self._position = _decodecursor(cursor)
+      if len(self._position) != len(self._orders) + 1:
+        raise BadValueError("Cursor does not match query")
+    else:
+      self._position = None
+    return self
+
+  def cursor(self):
+    """A cursor for the position after the last result fetched"""
+    if self._last is not None:
+      return _encodecursor(self._last)
+    if self._position is not None:
+      return _encodecursor(self._position)
+    return ''
+
+  def _where(self):
+    filters = list(self._filters)
+    params = list(self._params)
+    if self._position is not None:
+      # Rows after the position: those that sort after it on the first
+      # order, or equal on that and after it on the next, and so on, with
+      # the id as the final tie break. NULLs sort first.
+      columns = self._orders + [('_id', False)]
+      alternatives = []
+      for i in range(len(columns)):
+        terms = []
+        termparams = []
+        for (name, descending), value in zip(columns[:i], self._position[:i]):
+          if value is None:
+            terms.append('"%s" IS NULL' % (name, ))
+          else:
+            terms.append('"%s" = ?' % (name, ))
+            termparams.append(value)
+        name, descending = columns[i]
+        value = self._position[i]
+        if not descending and value is None:
+          terms.append('"%s" IS NOT NULL' % (name, ))
+        elif not descending:
+          terms.append('"%s" > ?' % (name, ))
+          termparams.append(value)
+        elif value is None:
+          continue
+        else:
+          terms.append('("%s" < ? OR "%s" IS NULL)' % (name, name))
+          termparams.append(value)
+        alternatives.append('(%s)' % (' AND '.join(terms), ))
+        params.extend(termparams)
+      filters.append('(%s)' % (' OR '.join(alternatives) or '0', ))
+    where = ''
+    if filters:
+      where = ' WHERE ' + ' AND '.join(filters)
+    return where, params
+
+  def _run(self, limit, offset):
+    cls = self._model_class
+    _ensuretable(cls)
+    where, params = self._where()
+    order = ', '.join(['"%s"%s' % (name, descending and ' DESC' or '')
+                       for name, descending in self._orders] + ['_id'])
+    sql = 'SELECT * FROM "%s"%s ORDER BY %s' % (cls.kind(), where, order)
+    if limit is not None:
+      sql += ' LIMIT %d OFFSET %d' % (limit, offset)
+    elif offset:
+      sql += ' LIMIT -1 OFFSET %d' % (offset, )
+    cursor = _connection().execute(sql, params)
+    columns = [d[0] for d in cursor.description]
+    positions = [columns.index(name) for name, descending in self._orders] + [0]
+    results = []
+    for row in cursor:
+      results.append(cls._fromrow(columns, row))
+      self._last = [row[p] for p in positions]
+    if self._keys_only:
+      return [entity.key() for entity in results]
+    return results
+
+  def fetch(self, limit, offset=0):
+    return self._run(limit, offset)
+
+  def get(self):
+    results = self._run(1, 0)
+    if results:
+      return results[0]
+    return None
+
+  def count(self, limit=None):
+    cls = self._model_class
+    _ensuretable(cls)
+    where, params = self._where()
+    sql = 'SELECT COUNT(*) FROM (SELECT _id FROM "%s"%s' % (cls.kind(), where)
+    if limit is not None:
+      sql += ' LIMIT %d' % (limit, )
+    return _connection().execute(sql + ')', params).fetchone()[0]
+
+  def __iter__(self):
+    return iter(self._run(None, 0))
@@ -0,0 +1,23 @@
+# Storage backend selection
+# Entities are kept in the App Engine datastore, unless COFFEESHOP_STORAGE
+# is set to sqlite:<path>, in which case they're kept in that SQLite
+# database instead (see sqlitedb.py), for running or benchmarking
+# coffeeshop on our own nodes. Either way, import db from here rather
+# than from google.appengine.ext.
+#
+# Only the datastore is replaced. coffeeshop still takes webapp,
+# templates, memcache, the task queue and urlfetch from the App Engine
+# SDK, so running it off App Engine still needs the SDK's libraries on
+# the path (e.g. under its development server) for everything but
+# storage.
+
+import os
+
+STORAGE = os.environ.get('COFFEESHOP_STORAGE', 'datastore')
+
+if STORAGE.startswith('sqlite:'):
+  import sqlitedb as db
+  db.configure(STORAGE[len('sqlite:'):],
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index.yaml'))
+else:
+  from google.appengine.ext import db
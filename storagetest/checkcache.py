@@ -0,0 +1,112 @@
+#!/usr/bin/python2.5
+
+import unittest
+import os, sys, threading, time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cache import LRUCache
+
+
+class LRUCacheTests(unittest.TestCase):
+
+  def testGetSet(self):
+    """Values set can be got back, and missing keys give the default"""
+    cache = LRUCache(3, 60)
+    cache.set('a', 1)
+    cache.set('b', None)
+    self.assertEqual(cache.get('a'), 1)
+    self.assertEqual(cache.get('b', 'default'), None)
+    self.assertEqual(cache.get('c'), None)
+    self.assertEqual(cache.get('c', 'default'), 'default')
+    self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+  def testReplace(self):
+    """Setting a key again replaces its value without adding an entry"""
+    cache = LRUCache(3, 60)
+    cache.set('a', 1)
+    cache.set('a', 2)
+    self.assertEqual(cache.get('a'), 2)
+    self.assertEqual(len(cache), 1)
+
+  def testEviction(self):
+    """When full, the least recently set entry is evicted"""
+    cache = LRUCache(3, 60)
+    for key in 'abcd':
+      cache.set(key, key)
+    self.assertEqual(len(cache), 3)
+    self.assertEqual([cache.get(key) for key in 'abcd'], [None, 'b', 'c', 'd'])
+
+  def testEvictionOrder(self):
+    """Getting or setting an entry makes it the most recently used"""
+    cache = LRUCache(3, 60)
+    for key in 'abc':
+      cache.set(key, key)
+    cache.get('a')
+    cache.set('b', 'B')
+    cache.set('d', 'd')
+    self.assertEqual(cache.get('c'), None)
+    cache.set('e', 'e')
+    self.assertEqual(cache.get('a'), None)
+    self.assertEqual([cache.get(key) for key in 'bde'], ['B', 'd', 'e'])
+
+  def testExpiry(self):
+    """Entries expire ttl seconds after they are set, however recently
+    they were got, and are removed when found expired
+    """
+    cache = LRUCache(3, 0.2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    time.sleep(0.1)
+    self.assertEqual(cache.get('a'), 1)
+    cache.set('b', 3)
+    time.sleep(0.15)
+    self.assertEqual(cache.get('a'), None)
+    self.assertEqual(cache.get('b'), 3)
+    self.assertEqual(len(cache), 1)
+
+  def testDelete(self):
+    """Deleted entries are gone, and deleting a missing key is harmless"""
+    cache = LRUCache(3, 60)
+    for key in 'abc':
+      cache.set(key, key)
+    cache.delete('b')
+    cache.delete('x')
+    self.assertEqual(len(cache), 2)
+    self.assertEqual([cache.get(key) for key in 'abc'], ['a', None, 'c'])
+    # The list stays intact, so eviction carries on in order
+    cache.set('d', 'd')
+    cache.set('e', 'e')
+    self.assertEqual([cache.get(key) for key in 'acde'], [None, 'c', 'd', 'e'])
+
+  def testClear(self):
+    """Clearing empties the cache, which can then be used again"""
+    cache = LRUCache(3, 60)
+    for key in 'abc':
+      cache.set(key, key)
+    cache.clear()
+    self.assertEqual(len(cache), 0)
+    self.assertEqual(cache.get('a'), None)
+    for key in 'defg':
+      cache.set(key, key)
+    self.assertEqual([cache.get(key) for key in 'defg'], [None, 'e', 'f', 'g'])
+
+  def testThreads(self):
+    """Concurrent use keeps the cache within its size"""
+    cache = LRUCache(50, 60)
+    def work(offset):
+      for i in range(2000):
+        cache.set((offset + i) % 100, i)
+        cache.get((offset + i * 7) % 100)
+        if i % 10 == 0:
+          cache.delete((offset + i * 3) % 100)
+    threads = [threading.Thread(target=work, args=(n * 13, )) for n in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertTrue(len(cache) <= 50)
+    self.assertEqual(len([key for key in range(100) if cache.get(key) is not None]), len(cache))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,346 @@
+#!/usr/bin/python2.5
+
+import unittest
+import os, sys, shutil, tempfile, threading, time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sqlitedb as db
+
+DBFILE = os.path.join(tempfile.mkdtemp(), 'checksqlitedb.db')
+db.configure(DBFILE)
+
+
+# Models
+class Owner(db.Model):
+  name = db.StringProperty()
+
+class Item(db.Model):
+  owner = db.ReferenceProperty(Owner)
+  name = db.StringProperty()
+  rank = db.IntegerProperty()
+  done = db.BooleanProperty(default=False)
+  data = db.BlobProperty()
+  created = db.DateTimeProperty(auto_now_add=True)
+
+class Counter(db.Model):
+  count = db.IntegerProperty(default=0)
+
+class Late(db.Model):
+  note = db.StringProperty()
+
+class Later(db.Model):
+  note = db.StringProperty()
+
+class Unused(db.Model):
+  note = db.StringProperty()
+
+
+def clear(*models):
+  """Deletes every entity of the given models"""
+  for model in models:
+    db.delete(model.all(keys_only=True).fetch(1000))
+
+
+class KeyTests(unittest.TestCase):
+
+  def setUp(self):
+    clear(Owner, Item)
+
+  def testIdKeys(self):
+    """Entities without a key name are given numeric ids"""
+    owner = Owner(name='a')
+    key = owner.put()
+    self.assertTrue(owner.is_saved())
+    self.assertEqual(key.kind(), 'Owner')
+    self.assertTrue(isinstance(key.id(), (int, long)))
+    self.assertEqual(key.name(), None)
+    self.assertEqual(Owner.get_by_id(key.id()).name, 'a')
+
+  def testNamedKeys(self):
+    """Key names are unique, and putting one again replaces the entity"""
+    Owner(key_name='bob', name='first').put()
+    key = Owner(key_name='bob', name='second').put()
+    self.assertEqual(key.name(), 'bob')
+    self.assertEqual(key.id(), None)
+    self.assertEqual(Owner.get_by_key_name('bob').name, 'second')
+    self.assertEqual(Owner.all().count(), 1)
+
+  def testStringKeys(self):
+    """Key strings round trip, and invalid ones are rejected"""
+    for key in [Owner(name='a').put(), Owner(key_name=u'n\xe9', name='b').put()]:
+      self.assertEqual(db.Key(str(key)), key)
+      self.assertEqual(hash(db.Key(str(key))), hash(key))
+      self.assertEqual(db.get(str(key)).key(), key)
+    self.assertRaises(db.BadKeyError, db.Key, 'not a key')
+
+  def testGetMissing(self):
+    """Batch gets keep their order, with None for missing entities"""
+    a = Owner(name='a').put()
+    b = Owner(name='b').put()
+    missing = db.Key.from_path('Owner', b.id() + 1000)
+    self.assertEqual([e and e.name for e in db.get([b, missing, a])], ['b', None, 'a'])
+    self.assertEqual(db.get(missing), None)
+
+  def testUnsaved(self):
+    """An unsaved entity without a key name has no key"""
+    self.assertRaises(db.NotSavedError, Owner().key)
+
+  def testDelete(self):
+    """Entities can be deleted by instance or key"""
+    a = Owner(name='a')
+    a.put()
+    b = Owner(name='b').put()
+    a.delete()
+    db.delete([b])
+    self.assertEqual(Owner.all().count(), 0)
+
+  def testReference(self):
+    """References are stored as keys and resolved on access"""
+    owner = Owner(name='a')
+    owner.put()
+    item = Item(owner=owner, name='x')
+    item.put()
+    item = Item.get(item.key())
+    self.assertEqual(item.owner.key(), owner.key())
+    self.assertEqual(item.owner.name, 'a')
+    self.assertRaises(db.KindError, Owner.get, item.key())
+
+  def testProperties(self):
+    """Property values survive a round trip through their columns"""
+    item = Item(name=u'caf\xe9', rank=3, done=True, data='\x00\xff')
+    item.put()
+    item = Item.get(item.key())
+    self.assertEqual(item.name, u'caf\xe9')
+    self.assertEqual(item.rank, 3)
+    self.assertEqual(item.done, True)
+    self.assertEqual(item.data, '\x00\xff')
+    self.assertTrue(abs(time.mktime(item.created.timetuple()) - time.time()) < 60)
+    self.assertRaises(db.BadValueError, Item, rank='three')
+
+
+class FilterTests(unittest.TestCase):
+
+  def setUp(self):
+    clear(Owner, Item)
+    self.owner = Owner(name='a')
+    self.owner.put()
+    self.other = Owner(name='b')
+    self.other.put()
+    items = []
+    for rank in [3, 1, None, 2, 5, 4]:
+      items.append(Item(owner=self.owner, name='r%s' % (rank, ), rank=rank, done=bool(rank and rank % 2)))
+    items.append(Item(owner=self.other, name='other', rank=1))
+    db.put(items)
+
+  def names(self, query):
+    return [item.name for item in query]
+
+  def testEquality(self):
+    """Equality filters, on references and values, combine"""
+    query = Item.all().filter('owner', self.owner).filter('done =', True).order('rank')
+    self.assertEqual(self.names(query), ['r1', 'r3', 'r5'])
+
+  def testInequality(self):
+    """Inequality filters leave out NULLs, except for !="""
+    query = Item.all().filter('owner =', self.owner).filter('rank >', 1).filter('rank <=', 4)
+    self.assertEqual(self.names(query.order('rank')), ['r2', 'r3', 'r4'])
+    query = Item.all().filter('owner =', self.owner).filter('rank !=', 3).order('rank')
+    self.assertEqual(self.names(query), ['rNone', 'r1', 'r2', 'r4', 'r5'])
+
+  def testNone(self):
+    """Filtering on None finds missing values"""
+    self.assertEqual(self.names(Item.all().filter('rank =', None)), ['rNone'])
+    self.assertRaises(db.BadValueError, Item.all().filter, 'rank >', None)
+
+  def testOrders(self):
+    """Sort orders apply in turn, with NULLs first"""
+    query = Item.all().filter('owner =', self.owner).order('-rank')
+    self.assertEqual(self.names(query), ['r5', 'r4', 'r3', 'r2', 'r1', 'rNone'])
+    query = Item.all().order('rank').order('-name')
+    self.assertEqual(self.names(query), ['rNone', 'r1', 'other', 'r2', 'r3', 'r4', 'r5'])
+
+  def testFetchAndCount(self):
+    """fetch takes a limit and offset, count an optional limit"""
+    query = Item.all().filter('owner =', self.owner).order('rank')
+    self.assertEqual([item.name for item in query.fetch(2, 1)], ['r1', 'r2'])
+    self.assertEqual(query.get().name, 'rNone')
+    self.assertEqual(query.count(), 6)
+    self.assertEqual(query.count(4), 4)
+    self.assertEqual(Item.all().filter('rank >', 9).get(), None)
+
+  def testKeysOnly(self):
+    """Keys only queries return keys"""
+    keys = Item.all(keys_only=True).filter('owner =', self.other).fetch(10)
+    self.assertEqual(len(keys), 1)
+    self.assertTrue(isinstance(keys[0], db.Key))
+
+  def testUnsupported(self):
+    """Unknown properties and operators are rejected"""
+    self.assertRaises(db.BadRequestError, Item.all().filter, 'colour =', 'red')
+    self.assertRaises(db.BadRequestError, Item.all().filter, 'rank IN', [1])
+    self.assertRaises(db.BadRequestError, Item.all().order, '-colour')
+
+
+class CursorTests(unittest.TestCase):
+
+  def setUp(self):
+    clear(Item)
+    db.put([Item(name='i%d' % (i, ), rank=i % 3) for i in range(10)])
+
+  def page(self, orders, size):
+    """Pages through all items, returning the names on each page"""
+    pages = []
+    cursor = None
+    while True:
+      query = Item.all()
+      for order in orders:
+        query.order(order)
+      query.with_cursor(cursor)
+      items = query.fetch(size)
+      if not items:
+        return pages
+      pages.append([item.name for item in items])
+      cursor = query.cursor()
+
+  def testPaging(self):
+    """Paging with cursors visits every entity once, in order"""
+    for orders in [[], ['rank'], ['-rank'], ['-rank', 'name'], ['rank', '-name']]:
+      query = Item.all()
+      for order in orders:
+        query.order(order)
+      expected = [item.name for item in query]
+      for size in [1, 3, 4, 10]:
+        pages = self.page(orders, size)
+        self.assertEqual(sum(pages, []), expected)
+        self.assertEqual(len(pages[0]), size)
+
+  def testNullPositions(self):
+    """Cursors positioned on NULLs page on correctly"""
+    db.put([Item(name='n%d' % (i, )) for i in range(3)])
+    for orders in [['rank'], ['-rank']]:
+      query = Item.all()
+      for order in orders:
+        query.order(order)
+      expected = [item.name for item in query]
+      self.assertEqual(sum(self.page(orders, 2), []), expected)
+
+  def testChanges(self):
+    """A cursor keeps its position when entities before it change"""
+    query = Item.all().order('name')
+    first = query.fetch(5)
+    cursor = query.cursor()
+    db.delete(first[:2])
+    Item(name='a').put()
+    Item(name='z').put()
+    rest = Item.all().order('name').with_cursor(cursor).fetch(100)
+    self.assertEqual([item.name for item in rest], ['i5', 'i6', 'i7', 'i8', 'i9', 'z'])
+
+  def testEmptyCursor(self):
+    """Without results, a query's cursor is the one it started from"""
+    self.assertEqual(Item.all().cursor(), '')
+    query = Item.all().order('name').with_cursor(None)
+    self.assertEqual(len(query.fetch(100)), 10)
+    cursor = query.cursor()
+    query = Item.all().order('name').with_cursor(cursor)
+    self.assertEqual(query.fetch(10), [])
+    self.assertEqual(query.cursor(), cursor)
+
+  def testBadCursors(self):
+    """Malformed cursors and cursors from other queries are rejected"""
+    query = Item.all().order('name')
+    query.fetch(1)
+    cursor = query.cursor()
+    self.assertRaises(db.BadValueError, Item.all().with_cursor, '!!!')
+    self.assertRaises(db.BadValueError, Item.all().order('name').order('rank').with_cursor, cursor)
+
+
+class TransactionTests(unittest.TestCase):
+
+  def setUp(self):
+    clear(Counter)
+
+  def increment(self, key, fail=False):
+    counter = Counter.get(key)
+    counter.count += 1
+    counter.put()
+    if fail:
+      raise ValueError('fail')
+    return counter.count
+
+  def testCommit(self):
+    """A transaction's writes are kept, and its result returned"""
+    key = Counter().put()
+    self.assertEqual(db.run_in_transaction(self.increment, key), 1)
+    self.assertEqual(Counter.get(key).count, 1)
+
+  def testRollback(self):
+    """A transaction's writes are undone when it raises"""
+    key = Counter().put()
+    self.assertRaises(ValueError, db.run_in_transaction, self.increment, key, fail=True)
+    self.assertEqual(Counter.get(key).count, 0)
+
+  def testNested(self):
+    """Transactions can't be nested"""
+    self.assertRaises(db.BadRequestError, db.run_in_transaction,
+      db.run_in_transaction, lambda: None)
+
+  def testConcurrent(self):
+    """Concurrent transactions are serialised, so no increment is lost"""
+    key = Counter().put()
+    errors = []
+    def work():
+      try:
+        for i in range(20):
+          db.run_in_transaction(self.increment, key)
+      except Exception, e:
+        errors.append(e)
+    threads = [threading.Thread(target=work) for i in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(errors, [])
+    self.assertEqual(Counter.get(key).count, 80)
+
+  def testNewKindRollback(self):
+    """A kind first stored in a transaction that rolls back is set up again"""
+    def fail():
+      Unused(note='x').put()
+      raise ValueError('fail')
+    self.assertRaises(ValueError, db.run_in_transaction, fail)
+    self.assertTrue('Unused' not in db._tables)
+    Unused(note='y').put()
+    self.assertEqual([u.note for u in Unused.all()], ['y'])
+
+  def testNewKindsConcurrently(self):
+    """A transaction can set up a new kind while another thread waits on
+    it to set up one of its own
+    """
+    started = threading.Event()
+    errors = []
+    def other():
+      try:
+        started.wait()
+        Later.all().count()
+        Later(note='b').put()
+      except Exception, e:
+        errors.append(e)
+    thread = threading.Thread(target=other)
+    thread.start()
+    def work():
+      started.set()
+      time.sleep(0.5)
+      Late(note='a').put()
+    began = time.time()
+    db.run_in_transaction(work)
+    thread.join()
+    self.assertEqual(errors, [])
+    self.assertTrue(time.time() - began < 10)
+    self.assertEqual(Late.all().count() + Later.all().count(), 2)
+
+
+if __name__ == '__main__':
+  try:
+    unittest.main()
+  finally:
+    shutil.rmtree(os.path.dirname(DBFILE))
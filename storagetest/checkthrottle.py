@@ -0,0 +1,176 @@
+#!/usr/bin/python2.5
+
+import unittest
+import os, sys, rfc822, time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from throttle import HostThrottle, parseretryafter
+
+# Throttles start out full at the time they're made, so the tests run
+# from a (whole) time after that
+NOW = float(int(time.time()) + 1000)
+
+
+def newThrottle():
+  """A throttle that opens after 3 failures for 10 seconds, up to 40, and
+  sends up to 4 deliveries a second, down to 0.5
+  """
+  return HostThrottle(3, 10, 40, 4, 0.5)
+
+
+class BreakerTests(unittest.TestCase):
+
+  def failures(self, throttle, times, now=NOW, status=500):
+    for i in range(times):
+      throttle.record(status, now=now)
+
+  def testOpens(self):
+    """The breaker opens after consecutive failures, and holds back
+    deliveries for the open time
+    """
+    throttle = newThrottle()
+    self.failures(throttle, 2)
+    self.assertEqual(throttle.state, HostThrottle.CLOSED)
+    self.assertTrue(throttle.acquire(NOW))
+    self.failures(throttle, 1)
+    self.assertEqual(throttle.state, HostThrottle.OPEN)
+    self.assertEqual(throttle.acquire(NOW + 5), False)
+    self.assertEqual(throttle.delay(NOW + 5), 5)
+
+  def testNoResponse(self):
+    """No response at all counts as a failure"""
+    throttle = newThrottle()
+    self.failures(throttle, 3, status=999)
+    self.assertEqual(throttle.state, HostThrottle.OPEN)
+
+  def testSuccessResets(self):
+    """A success in between failures starts the count again"""
+    throttle = newThrottle()
+    self.failures(throttle, 2)
+    throttle.record(200, now=NOW)
+    self.failures(throttle, 2)
+    self.assertEqual(throttle.state, HostThrottle.CLOSED)
+
+  def testClientErrors(self):
+    """A 4xx is the host answering, so it doesn't count as a failure"""
+    throttle = newThrottle()
+    self.failures(throttle, 2)
+    throttle.record(404, now=NOW)
+    self.failures(throttle, 2)
+    throttle.record(410, now=NOW)
+    self.assertEqual(throttle.state, HostThrottle.CLOSED)
+
+  def testHalfOpen(self):
+    """Once the open time is up, one trial delivery is let through, and
+    no other until it is recorded
+    """
+    throttle = newThrottle()
+    self.failures(throttle, 3)
+    self.assertTrue(throttle.acquire(NOW + 10))
+    self.assertEqual(throttle.state, HostThrottle.HALFOPEN)
+    self.assertEqual(throttle.acquire(NOW + 10), False)
+    self.assertEqual(throttle.delay(NOW + 10), 10)
+
+  def testTrialSucceeds(self):
+    """A successful trial delivery closes the breaker"""
+    throttle = newThrottle()
+    self.failures(throttle, 3)
+    throttle.acquire(NOW + 10)
+    throttle.record(200, now=NOW + 10)
+    self.assertEqual(throttle.state, HostThrottle.CLOSED)
+    self.assertTrue(throttle.acquire(NOW + 10))
+    self.failures(throttle, 2, NOW + 10)
+    self.assertEqual(throttle.state, HostThrottle.CLOSED)
+
+  def testTrialFails(self):
+    """A failed trial delivery opens the breaker again for twice as long,
+    up to the maximum, and a later success brings it back to the start
+    """
+    throttle = newThrottle()
+    self.failures(throttle, 3)
+    now = NOW
+    for opentime in [10, 20, 40, 40]:
+      now += opentime
+      self.assertEqual(throttle.acquire(now - 1), False)
+      self.assertTrue(throttle.acquire(now))
+      self.failures(throttle, 1, now)
+      self.assertEqual(throttle.state, HostThrottle.OPEN)
+    self.assertEqual(throttle.delay(now), 40)
+
+    now += 40
+    throttle.acquire(now)
+    throttle.record(200, now=now)
+    self.failures(throttle, 3, now)
+    self.assertEqual(throttle.delay(now), 10)
+
+
+class RateTests(unittest.TestCase):
+
+  def testBurst(self):
+    """Up to a second's worth of deliveries can be made at once, and
+    then they are spaced out at the rate
+    """
+    throttle = newThrottle()
+    for i in range(4):
+      self.assertTrue(throttle.acquire(NOW))
+    self.assertEqual(throttle.acquire(NOW), False)
+    self.assertEqual(throttle.delay(NOW), 0.25)
+    self.assertTrue(throttle.acquire(NOW + 0.25))
+
+  def testHalving(self):
+    """A 429 or 503 halves the rate, down to the minimum, and each
+    success adds one back, up to the maximum
+    """
+    throttle = newThrottle()
+    throttle.record(429, now=NOW)
+    self.assertEqual(throttle.rate, 2)
+    throttle.record(503, now=NOW)
+    self.assertEqual(throttle.rate, 1)
+    for i in range(3):
+      throttle.record(429, now=NOW)
+    self.assertEqual(throttle.rate, 0.5)
+    for rate in [1.5, 2.5, 3.5, 4, 4]:
+      throttle.record(200, now=NOW)
+      self.assertEqual(throttle.rate, rate)
+
+  def testSlowDown(self):
+    """A 429 empties the bucket, so the next delivery waits"""
+    throttle = newThrottle()
+    throttle.record(429, now=NOW)
+    self.assertEqual(throttle.acquire(NOW), False)
+    self.assertEqual(throttle.delay(NOW), 0.5)
+
+  def testRetryAfter(self):
+    """A Retry-After on a 429 or 503 holds back deliveries for as long"""
+    throttle = newThrottle()
+    throttle.record(429, '120', now=NOW)
+    self.assertEqual(throttle.delay(NOW), 120)
+    self.assertEqual(throttle.acquire(NOW + 119), False)
+    self.assertTrue(throttle.acquire(NOW + 121))
+
+  def testRetryAfterIgnored(self):
+    """A Retry-After on any other status is ignored"""
+    throttle = newThrottle()
+    throttle.record(500, '120', now=NOW)
+    self.assertEqual(throttle.delay(NOW), 0)
+
+
+class RetryAfterTests(unittest.TestCase):
+
+  def testSeconds(self):
+    self.assertEqual(parseretryafter('120'), 120)
+    self.assertEqual(parseretryafter(' 0 '), 0)
+
+  def testDate(self):
+    date = 'Wed, 21 Oct 2015 07:28:00 GMT'
+    then = rfc822.mktime_tz(rfc822.parsedate_tz(date))
+    self.assertEqual(parseretryafter(date, then - 30), 30)
+    self.assertEqual(parseretryafter(date, then + 30), 0)
+
+  def testInvalid(self):
+    for value in [None, '', 'soon', '-5']:
+      self.assertEqual(parseretryafter(value, NOW), None)
+
+
+if __name__ == '__main__':
+  unittest.main()
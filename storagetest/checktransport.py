@@ -0,0 +1,165 @@
+#!/usr/bin/python2.6
+
+import unittest
+import os, sys, threading, time
+import BaseHTTPServer, SocketServer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from transport import ConnectionPool, TransportError
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """A local keep-alive HTTP server that counts the connections made to
+  it and the most requests it has handled at once. Requests take delay
+  seconds. When dropping, it closes each connection after responding,
+  without saying so; when failing, without responding at all.
+  """
+  daemon_threads = True
+
+  def __init__(self):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+    self.lock = threading.Lock()
+    self.connections = 0
+    self.requests = 0
+    self.active = 0
+    self.maxactive = 0
+    self.delay = 0
+    self.dropping = False
+    self.failing = False
+
+  def url(self, path='/'):
+    return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.server.lock.acquire()
+    self.server.connections += 1
+    self.server.lock.release()
+
+  def do_POST(self):
+    self.rfile.read(int(self.headers.getheader('Content-Length') or 0))
+    server = self.server
+    server.lock.acquire()
+    server.requests += 1
+    server.active += 1
+    server.maxactive = max(server.maxactive, server.active)
+    server.lock.release()
+    time.sleep(server.delay)
+    server.lock.acquire()
+    server.active -= 1
+    server.lock.release()
+    if server.failing:
+      self.close_connection = 1
+      return
+    self.send_response(200)
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+    if server.dropping:
+      self.close_connection = 1
+
+  def log_message(self, format, *args):
+    pass
+
+
+class CountingPool(ConnectionPool):
+  """A pool that counts its connection acquisitions"""
+  acquired = 0
+
+  def _acquire(self, hostkey, reuse=True):
+    self.acquired += 1
+    return ConnectionPool._acquire(self, hostkey, reuse)
+
+
+class ConnectionPoolTests(unittest.TestCase):
+
+  def setUp(self):
+    self.server = Server()
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def testReuse(self):
+    """Requests to a host one after another share a connection"""
+    pool = ConnectionPool(2, 30, 5)
+    for i in range(3):
+      self.assertEqual(pool.post(self.server.url(), 'x', {}), (200, None))
+    self.assertEqual(self.server.connections, 1)
+
+  def testLimit(self):
+    """No more than maxperhost requests to a host are made at once"""
+    self.server.delay = 0.1
+    pool = ConnectionPool(2, 30, 5)
+    results = pool.postall([(self.server.url(), 'x', {})] * 6, 6)
+    self.assertEqual(results, [(200, None)] * 6)
+    self.assertEqual(self.server.maxactive, 2)
+    self.assertEqual(self.server.connections, 2)
+
+  def testWait(self):
+    """A request for a host at its limit waits for a connection to be
+    released, and fails if none is within the timeout
+    """
+    pool = ConnectionPool(1, 30, 0.2)
+    hostkey = ('http', '127.0.0.1', self.server.server_address[1])
+    connection, reused = pool._acquire(hostkey)
+    started = time.time()
+    self.assertRaises(TransportError, pool._acquire, hostkey)
+    self.assertTrue(time.time() - started >= 0.2)
+
+    timer = threading.Timer(0.1, pool._release, (hostkey, connection, True))
+    timer.start()
+    self.assertEqual(pool._acquire(hostkey), (connection, True))
+    timer.join()
+
+  def testIdleEviction(self):
+    """Connections idle for longer than idletimeout are closed"""
+    pool = ConnectionPool(2, 0.1, 5)
+    pool.post(self.server.url(), 'x', {})
+    time.sleep(0.2)
+    pool.post(self.server.url(), 'x', {})
+    self.assertEqual(self.server.connections, 2)
+    self.assertEqual(pool._open.values(), [1])
+
+  def testStaleRetry(self):
+    """A request on a reused connection the server has since closed is
+    retried on a new one
+    """
+    pool = ConnectionPool(2, 30, 5)
+    self.server.dropping = True
+    pool.post(self.server.url(), 'x', {})
+    self.server.dropping = False
+    time.sleep(0.1)
+    self.assertEqual(pool.post(self.server.url(), 'x', {}), (200, None))
+    self.assertEqual(self.server.connections, 2)
+
+  def testRetryOnce(self):
+    """A failed request is retried once, on a new connection, even with
+    other idle connections to the host
+    """
+    self.server.delay = 0.1
+    self.server.dropping = True
+    pool = CountingPool(3, 30, 5)
+    pool.postall([(self.server.url(), 'x', {})] * 3, 3)
+    self.assertEqual(self.server.connections, 3)
+    self.server.delay = 0
+    self.server.failing = True
+    time.sleep(0.1)
+    pool.acquired = 0
+    self.assertRaises(Exception, pool.post, self.server.url(), 'x', {})
+    self.assertEqual(pool.acquired, 2)
+    self.assertEqual(self.server.connections, 4)
+
+  def testBadURL(self):
+    pool = ConnectionPool(2, 30, 5)
+    self.assertRaises(TransportError, pool.post, 'ftp://example.com/', 'x', {})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,136 @@
+# Per-host delivery throttling for coffeeshop
+# Each subscriber host gets a circuit breaker, so a host that keeps
+# failing stops being sent deliveries for a while, and an adaptive token
+# bucket rate limit, so a host that answers 429 or 503 is sent deliveries
+# more slowly (and not at all for any Retry-After it gives) while healthy
+# hosts run at full speed.
+import rfc822
+import threading
+import time
+
+class HostThrottle(object):
+  """Circuit breaker and adaptive rate limit for deliveries to one host.
+
+  The breaker opens after failures consecutive failures (server errors,
+  or no response at all), holding deliveries back for opentime seconds.
+  Then one trial delivery is let through: if it succeeds the breaker
+  closes, if not it opens again for twice as long, up to maxopentime.
+  Any other answer, 4xx included, counts as a success here: a 404 or 410
+  means the host is up and answering, just not for that one subscriber,
+  whose deliveries back off and are dead-lettered on their own, and
+  tripping the breaker would hold back the host's other subscribers too.
+
+  The rate starts at maxrate deliveries a second. A 429 or 503 halves
+  it, down to minrate, and each success adds one back.
+  """
+  CLOSED, OPEN, HALFOPEN = 'closed', 'open', 'half-open'
+
+  def __init__(self, failures, opentime, maxopentime, maxrate, minrate):
+    self.failures = failures
+    self.opentime = opentime
+    self.maxopentime = maxopentime
+    self.maxrate = maxrate
+    self.minrate = minrate
+    self.state = self.CLOSED
+    self.rate = float(maxrate)
+    self._lock = threading.Lock()
+    self._failed = 0
+    self._open = opentime
+    self._until = 0
+    self._tokens = max(1.0, self.rate)
+    self._filled = time.time()
+
+  def _refill(self, now):
+    self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._filled) * self.rate)
+    self._filled = now
+
+  def delay(self, now=None):
+    """Number of seconds until a delivery may be made to the host"""
+    if now is None:
+      now = time.time()
+    self._lock.acquire()
+    try:
+      if self.state == self.HALFOPEN:
+        return self._open
+      if self._until > now:
+        return self._until - now
+      self._refill(now)
+      if self._tokens >= 1:
+        return 0
+      return (1 - self._tokens) / self.rate
+    finally:
+      self._lock.release()
+
+  def acquire(self, now=None):
+    """Takes the go-ahead for a delivery to the host, returning whether
+    one may be made now
+    """
+    if now is None:
+      now = time.time()
+    self._lock.acquire()
+    try:
+      if self.state == self.HALFOPEN:
+        return False
+      if self._until > now:
+        return False
+      if self.state == self.OPEN:
+        # Let a trial delivery through
+        self.state = self.HALFOPEN
+        return True
+      self._refill(now)
+      if self._tokens < 1:
+        return False
+      self._tokens -= 1
+      return True
+    finally:
+      self._lock.release()
+
+  def record(self, status, retryafter=None, now=None):
+    """Records the HTTP status (999 for none at all) of a delivery to
+    the host, and any Retry-After it came back with
+    """
+    if now is None:
+      now = time.time()
+    self._lock.acquire()
+    try:
+      if status in (429, 503):
+        self._refill(now)
+        self.rate = max(self.minrate, self.rate / 2)
+        self._tokens = min(self._tokens, 0)
+        pause = parseretryafter(retryafter, now)
+        if pause:
+          self._until = max(self._until, now + pause)
+      elif status < 400:
+        self.rate = min(self.maxrate, self.rate + 1)
+
+      if status >= 500:
+        self._failed += 1
+        if self.state == self.HALFOPEN:
+          self._open = min(self.maxopentime, self._open * 2)
+        if self.state == self.HALFOPEN or self._failed >= self.failures:
+          self.state = self.OPEN
+          self._until = max(self._until, now + self._open)
+      elif self.state != self.CLOSED or self._failed:
+        # The host answered, if only with a 4xx (see above)
+        self.state = self.CLOSED
+        self._failed = 0
+        self._open = self.opentime
+    finally:
+      self._lock.release()
+
+
+def parseretryafter(value, now=None):
+  """Number of seconds a Retry-After header value (either seconds, or
+  an HTTP date) asks us to wait, or None
+  """
+  if not value:
+    return None
+  value = value.strip()
+  if value.isdigit():
+    return int(value)
+  date = rfc822.parsedate_tz(value)
+  if date is None:
+    return None
+  if now is None:
+    now = time.time()
+  return max(0, rfc822.mktime_tz(date) - now)
@@ -0,0 +1,163 @@
+# Delivery transport for coffeeshop outside App Engine
+# Outside the urlfetch sandbox, deliveries are POSTed over keep-alive
+# connections pooled per subscriber host, rather than over a fresh
+# connection (and TCP and TLS handshake) each time. This is only ever
+# used outside App Engine, so it relies on httplib's connection timeouts
+# (Python 2.6 and later).
+import httplib
+import logging
+import socket
+import threading
+import time
+import urlparse
+
+class TransportError(Exception):
+  pass
+
+class ConnectionPool(object):
+  """A thread-safe pool of keep-alive HTTP and HTTPS connections, with at
+  most maxperhost connections (in use and idle) to any one host. A request
+  for a host that is at its limit waits for one of its connections to be
+  released. Connections left idle for idletimeout seconds are closed.
+  """
+  def __init__(self, maxperhost, idletimeout, timeout):
+    self.maxperhost = maxperhost
+    self.idletimeout = idletimeout
+    self.timeout = timeout
+    self._lock = threading.Condition()
+    # Idle connections, as lists of (connection, time released) with
+    # the most recently released last, and the number of connections
+    # open, by (scheme, host, port)
+    self._idle = {}
+    self._open = {}
+
+  def _evict(self, now):
+    """Closes connections that have been idle too long. Called with
+    the lock held
+    """
+    evicted = False
+    for hostkey, idle in self._idle.items():
+      while idle and now - idle[0][1] > self.idletimeout:
+        connection, released = idle.pop(0)
+        connection.close()
+        self._open[hostkey] -= 1
+        evicted = True
+      if not idle:
+        del self._idle[hostkey]
+    if evicted:
+      self._lock.notifyAll()
+
+  def _acquire(self, hostkey, reuse=True):
+    """Returns an idle connection to the host and True, or a new one
+    and False, waiting for one of the host's connections to be
+    released if it is at its limit. Without reuse, a new connection is
+    always made, closing an idle one to make way for it if need be.
+    """
+    deadline = time.time() + self.timeout
+    self._lock.acquire()
+    try:
+      while True:
+        now = time.time()
+        self._evict(now)
+        idle = self._idle.get(hostkey)
+        if idle and reuse:
+          return idle.pop()[0], True
+        if idle and self._open[hostkey] >= self.maxperhost:
+          idle.pop(0)[0].close()
+          self._open[hostkey] -= 1
+        if self._open.get(hostkey, 0) < self.maxperhost:
+          self._open[hostkey] = self._open.get(hostkey, 0) + 1
+          break
+        if now >= deadline:
+          raise TransportError("No connection to %s://%s:%d available" % hostkey)
+        self._lock.wait(deadline - now)
+    finally:
+      self._lock.release()
+
+    scheme, host, port = hostkey
+    try:
+      if scheme == 'https':
+        return httplib.HTTPSConnection(host, port, timeout=self.timeout), False
+      return httplib.HTTPConnection(host, port, timeout=self.timeout), False
+    except:
+      self._release(hostkey, None)
+      raise
+
+  def _release(self, hostkey, connection, reusable=False):
+    """Returns a connection to the pool if it can be reused, or
+    closes it and frees up its place otherwise
+    """
+    self._lock.acquire()
+    try:
+      if reusable:
+        self._idle.setdefault(hostkey, []).append((connection, time.time()))
+      else:
+        if connection is not None:
+          connection.close()
+        self._open[hostkey] -= 1
+      self._lock.notifyAll()
+    finally:
+      self._lock.release()
+
+  def post(self, url, payload, headers):
+    """POSTs payload to url, returning the response status and any
+    Retry-After header. A request on a reused connection that fails,
+    which is likely to be because the server closed it while it was idle,
+    is retried once on a new one.
+    """
+    parts = urlparse.urlsplit(url)
+    if parts[0] not in ('http', 'https') or not parts.hostname:
+      raise TransportError("Cannot deliver to %s" % (url, ))
+    hostkey = (parts[0], parts.hostname, parts.port or (parts[0] == 'https' and 443 or 80))
+    path = parts[2] or '/'
+    if parts[3]:
+      path += '?' + parts[3]
+
+    reuse = True
+    while True:
+      connection, reused = self._acquire(hostkey, reuse)
+      try:
+        connection.request('POST', path, payload, headers)
+        response = connection.getresponse()
+        response.read()
+      except (socket.error, httplib.HTTPException):
+        self._release(hostkey, connection)
+        if reused:
+          reuse = False
+          continue
+        raise
+      self._release(hostkey, connection, not response.will_close)
+      return response.status, response.getheader('Retry-After')
+
+  def postall(self, requests, concurrency):
+    """Makes a POST for each (url, payload, headers) tuple in requests,
+    from up to concurrency threads at once. Returns a list of (HTTP status,
+    Retry-After) tuples in the same order as requests; a request that fails
+    to complete at all gets a status of 999.
+    """
+    results = [(999, None)] * len(requests)
+    pending = range(len(requests))
+    pending.reverse()
+    lock = threading.Lock()
+
+    def work():
+      while True:
+        lock.acquire()
+        try:
+          if not pending:
+            return
+          index = pending.pop()
+        finally:
+          lock.release()
+        url, payload, headers = requests[index]
+        try:
+          results[index] = self.post(url, payload, headers)
+        except:
+          logging.error("transport encountered an EXCEPTION for %s" % (url, ))
+
+    threads = [threading.Thread(target=work) for i in range(min(concurrency, len(requests)))]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    return results